@@ -0,0 +1,77 @@
+"""
+Compare reading a compressed CSV as a stream against extracting it to disk first.
+Usage: python benchmarks/compressed_csv.py [rows]
+"""
+import csv
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import time
+from mcneelat.pyutils.fileutils import ArchiveUtils, CSVUtils
+
+
+def timed(label, size, func):
+    """
+    Run func and print its throughput.
+    :param label: name of the benchmark
+    :param size: uncompressed size in bytes of the CSV data
+    :param func: function returning the number of rows read
+    :return: None
+    """
+    start = time.time()
+    rows = func()
+    elapsed = time.time() - start
+    print("%-32s %8d rows %8.2fs %8.1f MB/s" % (label, rows, elapsed, size / elapsed / 1e6))
+
+
+def main(rows):
+    workdir = tempfile.mkdtemp()
+    try:
+        plain = os.path.join(workdir, 'flows.csv')
+        with open(plain, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['ts', 'src', 'dst', 'bytes'])
+            for i in range(rows):
+                writer.writerow([1500000000 + i, '10.%d.%d.%d' % (i % 256, i % 200, i % 100), '192.168.1.%d' % (i % 250),
+                                 i * 7 % 65536])
+        size = os.path.getsize(plain)
+        gz = plain + '.gz'
+        with open(plain, 'rb') as src, gzip.open(gz, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        ArchiveUtils.create_tar([plain], os.path.join(workdir, 'flows'), 'gz')
+        tar = os.path.join(workdir, 'flows.tar.gz')
+        member = plain.lstrip('/')
+
+        def count(infile):
+            return sum(1 for _ in CSVUtils.read_csv_iter(infile, selected_columns=['src', 'bytes']))
+
+        def gunzip_then_read():
+            scratch = os.path.join(workdir, 'gunzip.csv')
+            with gzip.open(gz, 'rb') as src, open(scratch, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            try:
+                return count(scratch)
+            finally:
+                os.remove(scratch)
+
+        def extract_then_read():
+            scratch = os.path.join(workdir, 'extract')
+            ArchiveUtils.extract_tar(tar, scratch)
+            try:
+                return count(os.path.join(scratch, member))
+            finally:
+                shutil.rmtree(scratch)
+
+        timed('plain csv', size, lambda: count(plain))
+        timed('csv.gz, gunzip to disk + read', size, gunzip_then_read)
+        timed('csv.gz, streamed', size, lambda: count(gz))
+        timed('tar.gz, extract + read', size, extract_then_read)
+        timed('tar.gz member, streamed', size, lambda: count((tar, member)))
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -1,18 +1,265 @@
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from itertools import count, islice
 from mcneelat.pyutils.confutils import AbstractLogUtils
+from mcneelat.pyutils.fileutils import CSVUtils
 import psycopg2
+from psycopg2 import extras as pgextras, sql as pgsql
+import re
+import threading
+import time
+
+
+class QueryCache(object):
+    """Thread-safe, size-bounded LRU cache of query results with a TTL, tagged by the tables each query reads."""
+
+    """Pattern splitting a statement into string literals, (possibly qualified) names, parentheses and commas."""
+    token_re = re.compile(r"'(?:[^']|'')*'|(?:\"[^\"]*\"|\w+)(?:\.(?:\"[^\"]*\"|\w+))*|[(),]|[^\s\w(),'\"]+")
+
+    """Keywords that end a FROM list."""
+    from_list_end = frozenset(('where', 'group', 'having', 'window', 'order', 'limit', 'offset', 'fetch', 'for',
+                               'union', 'intersect', 'except', 'returning', 'select', 'set', 'values'))
+
+    """Keywords that may precede a table name in a FROM list or JOIN."""
+    table_prefixes = frozenset(('only', 'lateral'))
+
+    """Pattern matching the table a statement writes to."""
+    write_tables_re = re.compile(r'\b(?:insert\s+into|update|delete\s+from|'
+                                 r'(?:alter|drop)\s+table(?:\s+if\s+exists)?|copy)\s+(?:only\s+)?'
+                                 r'((?:"[^"]+"|\w+)(?:\.(?:"[^"]+"|\w+))*)', re.IGNORECASE)
+
+    """Pattern matching the comma separated tables of a TRUNCATE statement."""
+    truncate_tables_re = re.compile(r'\btruncate\s+(?:table\s+)?((?:(?:only\s+)?(?:"[^"]+"|\w+)'
+                                    r'(?:\.(?:"[^"]+"|\w+))*\s*,\s*)*(?:only\s+)?(?:"[^"]+"|\w+)'
+                                    r'(?:\.(?:"[^"]+"|\w+))*)', re.IGNORECASE)
+
+    def __init__(self, max_entries=1024, ttl=60):
+        """
+        Initialize class.
+        :param max_entries: maximum number of results kept before the least recently used is evicted
+        :param ttl: seconds a result stays valid; None keeps results until evicted or invalidated
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.tags = {}
+        # per table tag, how many times it was invalidated; lets put() refuse a result read before an invalidation
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def table_tag(table):
+        """
+        Normalize a table name into a tag; the schema is dropped so qualified and unqualified names match.
+        :param table: table name, optionally as schema.table and/or quoted
+        :return: lower case table name
+        """
+        return table.rsplit('.', 1)[-1].strip('"').lower()
+
+    @staticmethod
+    def tables_read(sql):
+        """
+        Find the tables a SQL statement reads from: every item of every FROM list (comma joins included), every
+        JOIN, and the same inside subqueries. Function names in a FROM list are returned too, which only means a
+        result may be invalidated more often than needed.
+        :param sql: SQL statement
+        :return: set of table tags
+        """
+        tables = set()
+        # per parenthesis depth: [inside a FROM list, expecting a table name next]
+        stack = [[False, False]]
+        for token in QueryCache.token_re.findall(sql):
+            state = stack[-1]
+            word = token.lower()
+            if token == '(':
+                # a subquery or function call takes the place of a FROM list item
+                state[1] = False
+                stack.append([False, False])
+            elif token == ')':
+                if len(stack) > 1:
+                    stack.pop()
+            elif word in ('from', 'join'):
+                state[0] = state[1] = True
+            elif state[1]:
+                if word not in QueryCache.table_prefixes:
+                    state[1] = False
+                    if token[0] == '"' or token[0].isalpha() or token[0] == '_':
+                        tables.add(QueryCache.table_tag(token))
+            elif token == ',':
+                state[1] = state[0]
+            elif word in QueryCache.from_list_end:
+                state[0] = False
+        return tables
+
+    @staticmethod
+    def tables_written(sql):
+        """
+        Find the tables a SQL statement writes to.
+        :param sql: SQL statement
+        :return: set of table tags
+        """
+        tables = set(QueryCache.table_tag(t) for t in QueryCache.write_tables_re.findall(sql))
+        for names in QueryCache.truncate_tables_re.findall(sql):
+            for name in names.split(','):
+                name = name.strip()
+                if name.lower().startswith('only '):
+                    name = name[5:].strip()
+                tables.add(QueryCache.table_tag(name))
+        return tables
+
+    @staticmethod
+    def make_key(sql, params):
+        """
+        Build a hashable cache key from a statement and its parameters.
+        :param sql: SQL statement
+        :param params: parameter sequence or dictionary, or None
+        :return: hashable key
+        """
+        if isinstance(params, dict):
+            params = tuple(sorted(params.items()))
+        elif params is not None:
+            params = tuple(params)
+        try:
+            hash(params)
+        except TypeError:
+            params = repr(params)
+        return sql, params
+
+    def get(self, key):
+        """
+        Look up a cached result, counting a hit or a miss.
+        :param key: key from make_key
+        :return: cached rows, or None if missing or expired
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] is not None and entry[0] <= time.time():
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def versions_of(self, tables):
+        """
+        Take a snapshot of the invalidation counts of some tables, to pass to put() once the result has been read.
+        :param tables: iterable of table tags
+        :return: dictionary of table tag to invalidation count
+        """
+        with self.lock:
+            return dict((table, self.versions.get(table, 0)) for table in tables)
+
+    def put(self, key, rows, tables, ttl=None, versions=None):
+        """
+        Store a result, evicting the least recently used results beyond max_entries.
+        :param key: key from make_key
+        :param rows: result rows
+        :param tables: iterable of tags of the tables the result depends on
+        :param ttl: seconds the result stays valid; default is the cache's ttl
+        :param versions: optional snapshot from versions_of taken before the result was read; the result isn't stored
+            if any of those tables was invalidated since, as it may predate the change
+        :return: None
+        """
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.time() + ttl
+        tables = frozenset(tables)
+        with self.lock:
+            if versions and any(self.versions.get(table, 0) != version for table, version in versions.items()):
+                return
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (expires, tables, rows)
+            for table in tables:
+                self.tags.setdefault(table, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._drop(next(iter(self.entries)))
+                self.evictions += 1
+
+    def _drop(self, key):
+        """
+        Remove an entry and its tag references; the lock must be held.
+        :param key: key of the entry
+        :return: None
+        """
+        _, tables, _ = self.entries.pop(key)
+        for table in tables:
+            keys = self.tags.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tags[table]
+
+    def invalidate(self, *tables):
+        """
+        Drop every cached result that depends on any of the given tables.
+        :param tables: table names
+        :return: number of results dropped
+        """
+        dropped = 0
+        with self.lock:
+            for table in tables:
+                tag = self.table_tag(table)
+                self.versions[tag] = self.versions.get(tag, 0) + 1
+                for key in list(self.tags.get(tag, ())):
+                    self._drop(key)
+                    dropped += 1
+            self.invalidations += dropped
+        return dropped
+
+    def clear(self):
+        """
+        Drop every cached result.
+        :return: None
+        """
+        with self.lock:
+            self.entries.clear()
+            self.tags.clear()
+
+    def stats(self):
+        """
+        Get cache statistics.
+        :return: dictionary of hits, misses, hit_ratio, entries, evictions and invalidations
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses, 'hit_ratio': self.hits / lookups if lookups else 0.0,
+                    'entries': len(self.entries), 'evictions': self.evictions, 'invalidations': self.invalidations}
 
 
 class AbstractDBUtils(AbstractLogUtils):
     """Class containing handy methods common to working with any SQL database."""
 
-    def __init__(self, dbconn, verbose=True):
+    """Row types select_iter can build from each batch of fetched tuples."""
+    row_types = (None, 'dict', 'namedtuple')
+
+    """Pattern matching the parameter placeholders (and escaped percent signs) in a SQL statement."""
+    placeholder_re = re.compile(r'%%|%s|%\((\w+)\)s')
+
+    """Counter naming prepared statements; shared so names never clash on a connection reused by several instances."""
+    prepared_ids = count()
+
+    def __init__(self, dbconn, verbose=True, prepared_cache_size=64, query_cache=None):
         """
         Initialize class.
         :param dbconn: database connection object
         :param verbose: whether or not to print log messages
+        :param prepared_cache_size: maximum number of server-side prepared statements kept on the connection
+        :param query_cache: optional QueryCache object used by select_cached; it may be shared between instances
         """
         self.dbconn = dbconn
         self.cursor = self.dbconn.cursor()
+        self.prepared = OrderedDict()
+        self.prepared_cache_size = prepared_cache_size
+        self.query_cache = query_cache
+        # tables written in the open transaction, invalidated again once it commits
+        self.pending_tables = set()
         AbstractLogUtils.__init__(self, verbose)
 
     def select(self, sql):
@@ -29,6 +276,129 @@ class AbstractDBUtils(AbstractLogUtils):
             row = self.cursor.fetchone()
         return results
 
+    def select_cached(self, sql, params=None, tables=None, ttl=None):
+        """
+        Execute a SQL SELECT statement through the query cache, so repeated reads are answered without touching the
+        database until the result expires or one of its tables is written.
+        :param sql: SQL SELECT statement
+        :param params: optional parameters for the statement
+        :param tables: table names the result depends on; default is the tables found in FROM lists and JOINs, and
+            a result with none found isn't cached
+        :param ttl: seconds the result stays valid; default is the cache's ttl
+        :return: results of executed statement
+        """
+        if tables is None and self.query_cache is not None:
+            tables = QueryCache.tables_read(sql)
+        # nothing to invalidate the result by (i.e. a function call), or this connection sees its own uncommitted
+        # writes, which must neither be cached nor be hidden behind results cached from other connections
+        if self.query_cache is None or not tables or self.pending_tables:
+            self.cursor.execute(sql, params)
+            return self.cursor.fetchall()
+        key = QueryCache.make_key(sql, params)
+        rows = self.query_cache.get(key)
+        if rows is None:
+            tables = set(map(QueryCache.table_tag, tables))
+            versions = self.query_cache.versions_of(tables)
+            self.cursor.execute(sql, params)
+            rows = tuple(self.cursor.fetchall())
+            self.query_cache.put(key, rows, tables, ttl, versions)
+        return list(rows)
+
+    def invalidate(self, *tables):
+        """
+        Drop cached results that depend on the given tables, i.e. after they were changed outside of this object.
+        :param tables: table names
+        :return: number of results dropped
+        """
+        if self.query_cache is None:
+            return 0
+        return self.query_cache.invalidate(*tables)
+
+    def _invalidate_writes(self, sql):
+        """
+        Drop cached results that depend on the tables a statement writes to.
+        :param sql: SQL statement
+        :return: None
+        """
+        if self.query_cache is not None:
+            if not isinstance(sql, str):
+                sql = sql.as_string(self.dbconn)
+            self._invalidate_tables(QueryCache.tables_written(sql))
+
+    def _invalidate_tables(self, tables):
+        """
+        Drop cached results that depend on tables written through this object. Outside of autocommit mode the tables
+        are also remembered, since other connections may cache the old rows again until the transaction commits.
+        :param tables: table names
+        :return: None
+        """
+        if self.query_cache is not None and tables:
+            self.query_cache.invalidate(*tables)
+            if not getattr(self.dbconn, 'autocommit', False):
+                self.pending_tables.update(tables)
+
+    def commit(self):
+        """
+        Commit the open transaction, then drop cached results that depend on the tables it wrote to.
+        :return: None
+        """
+        self.dbconn.commit()
+        if self.pending_tables:
+            tables, self.pending_tables = self.pending_tables, set()
+            self.query_cache.invalidate(*tables)
+
+    def rollback(self):
+        """
+        Roll back the open transaction; cached results are still valid since none of its writes became visible.
+        :return: None
+        """
+        self.dbconn.rollback()
+        self.pending_tables.clear()
+
+    def select_iter(self, sql, params=None, itersize=2000, row_type=None):
+        """
+        Execute a SQL SELECT statement and stream the results in batches, so memory use doesn't grow with the result.
+        :param sql: SQL SELECT statement
+        :param params: optional parameters for the statement
+        :param itersize: number of rows fetched per round trip
+        :param row_type: None for tuples, 'dict' for dictionaries, or 'namedtuple' for named tuples
+        :return: generator of rows
+        """
+        if row_type not in self.row_types:
+            raise ValueError('Invalid row type %s!' % row_type)
+        cursor = self._stream_cursor(itersize)
+        try:
+            cursor.execute(sql, params)
+            make_row = None
+            rows = cursor.fetchmany(itersize)
+            while rows:
+                if row_type is not None and make_row is None:
+                    # column names are only known once the first batch has been fetched
+                    columns = [column[0] for column in cursor.description]
+                    if row_type == 'dict':
+                        make_row = lambda row: dict(zip(columns, row))
+                    else:
+                        make_row = namedtuple('Row', columns, rename=True)._make
+                if make_row is None:
+                    for row in rows:
+                        yield row
+                else:
+                    for row in map(make_row, rows):
+                        yield row
+                rows = cursor.fetchmany(itersize)
+        finally:
+            cursor.close()
+
+    def _stream_cursor(self, itersize):
+        """
+        Create a cursor for streaming a result set; subclasses override this to use server-side cursors.
+        :param itersize: number of rows fetched per round trip
+        :return: cursor object
+        """
+        cursor = self.dbconn.cursor()
+        cursor.arraysize = itersize
+        return cursor
+
     def runsql(self, sql, commit=True):
         """
         Execute a SQL statement of any type that doesn't require a result (i.e. not SELECT).
@@ -37,8 +407,139 @@ class AbstractDBUtils(AbstractLogUtils):
         :return: None
         """
         self.cursor.execute(sql)
+        self._invalidate_writes(sql)
+        if commit:
+            self.commit()
+
+    def execute_many(self, sql, params_list, page_size=100, commit=True):
+        """
+        Execute a parameterized SQL statement once for each set of parameters, sending them in pages.
+        :param sql: SQL statement with parameter placeholders (i.e. UPDATE t SET a = %s WHERE id = %s)
+        :param params_list: iterable of parameter sequences or dictionaries
+        :param page_size: number of parameter sets sent per round trip
+        :param commit: whether or not to commit after all pages are executed
+        :return: None
+        """
+        params_list = iter(params_list)
+        page = list(islice(params_list, page_size))
+        while page:
+            self.cursor.executemany(sql, page)
+            page = list(islice(params_list, page_size))
+        self._invalidate_writes(sql)
         if commit:
-            self.dbconn.commit()
+            self.commit()
+
+    def execute_values(self, sql, values_list, template=None, page_size=100, commit=True, fetch=False):
+        """
+        Execute a statement with a VALUES list (i.e. INSERT INTO t (a, b) VALUES %s), expanding one page of rows into
+        each statement.
+        :param sql: SQL statement containing a single %s placeholder where the VALUES rows go
+        :param values_list: iterable of row sequences
+        :param template: placeholder for one row (i.e. (%s, %s)); default matches the length of the first row
+        :param page_size: number of rows per statement
+        :param commit: whether or not to commit after all pages are executed
+        :param fetch: whether or not to collect and return rows produced by the statement (i.e. with RETURNING)
+        :return: list of fetched rows if fetch, None otherwise
+        """
+        results = [] if fetch else None
+        values_list = iter(values_list)
+        page = list(islice(values_list, page_size))
+        while page:
+            row_template = template or '(%s)' % ', '.join(['%s'] * len(page[0]))
+            before, after = sql.split('%s', 1)
+            params = [value for row in page for value in row]
+            self.cursor.execute(before + ', '.join([row_template] * len(page)) + after, params)
+            if fetch:
+                results.extend(self.cursor.fetchall())
+            page = list(islice(values_list, page_size))
+        self._invalidate_writes(sql)
+        if commit:
+            self.commit()
+        return results
+
+    def execute_prepared(self, sql, params=None, commit=True):
+        """
+        Execute a parameterized SQL statement through a server-side prepared statement, which is prepared on first use
+        and then reused, so the server parses and plans it only once.
+        :param sql: SQL statement with %s or %(name)s parameter placeholders
+        :param params: parameter sequence or dictionary
+        :param commit: whether or not to commit any changes made by the statement
+        :return: number of rows affected
+        """
+        self._execute_prepared(sql, params)
+        self._invalidate_writes(sql)
+        if commit:
+            self.commit()
+        return self.cursor.rowcount
+
+    def select_prepared(self, sql, params=None):
+        """
+        Execute a parameterized SQL SELECT statement through a cached server-side prepared statement.
+        :param sql: SQL SELECT statement with %s or %(name)s parameter placeholders
+        :param params: parameter sequence or dictionary
+        :return: results of executed statement
+        """
+        self._execute_prepared(sql, params)
+        return self.cursor.fetchall()
+
+    def _execute_prepared(self, sql, params):
+        """
+        Execute a statement through the prepared statement cache, preparing it and evicting the least recently used
+        statement if needed.
+        :param sql: SQL statement with %s or %(name)s parameter placeholders
+        :param params: parameter sequence or dictionary
+        :return: None
+        """
+        entry = self.prepared.get(sql)
+        if entry is None:
+            name = 'pyutils_prepared_%d' % next(self.prepared_ids)
+            names = []
+
+            def number(match):
+                if match.group(0) == '%%':
+                    return '%'
+                names.append(match.group(1))
+                return '$%d' % len(names)
+
+            self.cursor.execute(self._prepare_sql(name, self.placeholder_re.sub(number, sql)))
+            entry = self.prepared[sql] = (name, names)
+            while len(self.prepared) > self.prepared_cache_size:
+                _, (old_name, _) = self.prepared.popitem(last=False)
+                self.cursor.execute(self._deallocate_sql(old_name))
+        else:
+            self.prepared.move_to_end(sql)
+        name, names = entry
+        if isinstance(params, dict):
+            params = [params[n] for n in names]
+        self.cursor.execute(self._execute_sql(name, len(names)), params)
+
+    def _prepare_sql(self, name, sql):
+        """
+        Build the statement preparing a query; the default is PostgreSQL syntax.
+        :param name: prepared statement name
+        :param sql: statement with $1, $2, ... placeholders
+        :return: SQL string
+        """
+        return 'PREPARE %s AS %s' % (name, sql)
+
+    def _execute_sql(self, name, param_count):
+        """
+        Build the statement executing a prepared query; the default is PostgreSQL syntax.
+        :param name: prepared statement name
+        :param param_count: number of parameters
+        :return: SQL string with one placeholder per parameter
+        """
+        if not param_count:
+            return 'EXECUTE %s' % name
+        return 'EXECUTE %s (%s)' % (name, ', '.join(['%s'] * param_count))
+
+    def _deallocate_sql(self, name):
+        """
+        Build the statement releasing a prepared query; the default is PostgreSQL syntax.
+        :param name: prepared statement name
+        :return: SQL string
+        """
+        return 'DEALLOCATE %s' % name
 
     def runsqlmulti(self, sql):
         """
@@ -48,7 +549,7 @@ class AbstractDBUtils(AbstractLogUtils):
         """
         for s in sql:
             self.runsql(s, commit=False)
-        self.dbconn.commit()
+        self.commit()
 
     def close(self):
         """
@@ -60,18 +561,438 @@ class AbstractDBUtils(AbstractLogUtils):
         self.dbconn.close()
 
 
+class _CopyBuffer(object):
+    """Read-only file object rendering rows in COPY text format on demand, so the payload is never all in memory."""
+
+    """Translation table escaping the characters that are special in COPY text format."""
+    escapes = {ord('\\'): '\\\\', ord('\t'): '\\t', ord('\n'): '\\n', ord('\r'): '\\r'}
+
+    def __init__(self, rows, empty_as_null=False):
+        """
+        Initialize class.
+        :param rows: iterable of rows (lists or tuples)
+        :param empty_as_null: whether or not to load empty strings as NULL
+        """
+        self.rows = iter(rows)
+        self.empty_as_null = empty_as_null
+
+    def read(self, size=-1):
+        lines = []
+        length = 0
+        escapes = self.escapes
+        for row in self.rows:
+            fields = ['\\N' if value is None or (self.empty_as_null and value == '') else
+                      str(value).translate(escapes) for value in row]
+            line = '\t'.join(fields) + '\n'
+            lines.append(line)
+            length += len(line)
+            if 0 <= size <= length:
+                break
+        return ''.join(lines)
+
+    readline = read
+
+
 class PGUtils(AbstractDBUtils):
     """Class to initialize a connection to a PostgreSQL database."""
 
-    def __init__(self, conf_data, schema=None, verbose=True):
+    """Counter naming server-side cursors; shared so names never clash on a connection reused by several instances."""
+    cursor_ids = count()
+
+    def __init__(self, conf_data, schema=None, verbose=True, prepared_cache_size=64, dbconn=None, query_cache=None):
         """
         Initialize class.
         :param conf_data: configuration data to initialize database
         :param schema: database schema location
+        :param verbose: whether or not to print log messages
+        :param prepared_cache_size: maximum number of server-side prepared statements kept on the connection
+        :param dbconn: existing connection to use (i.e. one checked out of a PGConnectionPool) instead of connecting
+        :param query_cache: optional QueryCache object used by select_cached
         """
         self.conf_data = conf_data
         self.schema = schema
-        if verbose:
-            print("[*] Connecting to database...")
-        dbconn = psycopg2.connect(**conf_data["DB_CONN_INFO"])
-        AbstractDBUtils.__init__(self, dbconn, verbose)
+        if dbconn is None:
+            if verbose:
+                print("[*] Connecting to database...")
+            dbconn = psycopg2.connect(**conf_data["DB_CONN_INFO"])
+        AbstractDBUtils.__init__(self, dbconn, verbose, prepared_cache_size, query_cache)
+
+    def execute_many(self, sql, params_list, page_size=100, commit=True):
+        """
+        Execute a parameterized SQL statement once for each set of parameters, joining each page of statements into
+        a single round trip with psycopg2.extras.execute_batch.
+        :param sql: SQL statement with parameter placeholders (i.e. UPDATE t SET a = %s WHERE id = %s)
+        :param params_list: iterable of parameter sequences or dictionaries
+        :param page_size: number of statements sent per round trip
+        :param commit: whether or not to commit after all pages are executed
+        :return: None
+        """
+        pgextras.execute_batch(self.cursor, sql, params_list, page_size)
+        self._invalidate_writes(sql)
+        if commit:
+            self.commit()
+
+    def execute_values(self, sql, values_list, template=None, page_size=100, commit=True, fetch=False):
+        """
+        Execute a statement with a VALUES list (i.e. INSERT INTO t (a, b) VALUES %s) using
+        psycopg2.extras.execute_values.
+        :param sql: SQL statement containing a single %s placeholder where the VALUES rows go
+        :param values_list: iterable of row sequences
+        :param template: placeholder for one row (i.e. (%s, %s)); default matches the length of the first row
+        :param page_size: number of rows per statement
+        :param commit: whether or not to commit after all pages are executed
+        :param fetch: whether or not to collect and return rows produced by the statement (i.e. with RETURNING)
+        :return: list of fetched rows if fetch, None otherwise
+        """
+        results = pgextras.execute_values(self.cursor, sql, values_list, template, page_size, fetch)
+        self._invalidate_writes(sql)
+        if commit:
+            self.commit()
+        return results
+
+    def _stream_cursor(self, itersize):
+        """
+        Create a named, server-side cursor so PostgreSQL holds the result set and sends it one batch at a time.
+        :param itersize: number of rows fetched per round trip
+        :return: psycopg2 named cursor object
+        """
+        # a server-side cursor only lives inside a transaction unless it is declared WITH HOLD
+        cursor = self.dbconn.cursor(name='pyutils_stream_%d' % next(self.cursor_ids),
+                                    withhold=self.dbconn.autocommit)
+        cursor.itersize = itersize
+        return cursor
+
+    def _table_identifier(self, table):
+        """
+        Build a quoted table identifier, qualified with the configured schema when the name has none.
+        :param table: table name, optionally as schema.table
+        :return: psycopg2.sql.Identifier object
+        """
+        parts = table.split('.')
+        if len(parts) == 1 and self.schema:
+            parts.insert(0, self.schema)
+        return pgsql.Identifier(*parts)
+
+    def bulk_load(self, table, source, columns=None, has_headers=True, upsert_keys=None, chunk_size=1024 * 1024,
+                  empty_as_null=False, commit=True):
+        """
+        Load rows into a table with COPY ... FROM STDIN, streaming the data in chunks.
+        :param table: table to load into, optionally as schema.table
+        :param source: iterable of rows (i.e. a CSVUtils.read_csv_iter generator), a path to a CSV file (compressed
+            files and archive members are read as in CSVUtils.open_csv), or a file object of CSV text
+        :param columns: list of target column names in the order they appear in each row; default is all columns
+        :param has_headers: whether or not a CSV file source has a header line to skip; ignored for rows
+        :param upsert_keys: list of key columns; if given, rows are copied into a temporary staging table and merged
+            with INSERT ... ON CONFLICT, updating the other columns of existing rows; when the data has the same key
+            more than once, the last row wins
+        :param chunk_size: size in bytes of the chunks sent to the server
+        :param empty_as_null: whether or not to load empty strings from a row source as NULL
+        :param commit: whether or not to commit after loading
+        :return: number of rows loaded (or inserted/updated when upserting)
+        """
+        target = self._table_identifier(table)
+        column_list = pgsql.SQL('')
+        if columns:
+            column_list = pgsql.SQL('({})').format(pgsql.SQL(', ').join(map(pgsql.Identifier, columns)))
+        if isinstance(source, str) or hasattr(source, 'read'):
+            options = pgsql.SQL('(FORMAT csv, HEADER true)' if has_headers else '(FORMAT csv)')
+        else:
+            options = pgsql.SQL('(FORMAT text)')
+            source = _CopyBuffer(source, empty_as_null)
+        with self.dbconn.cursor() as cursor:
+            copy_target = target
+            # in autocommit mode the ON COMMIT DROP staging table would vanish right after CREATE, so the upsert
+            # runs in an explicit transaction
+            explicit = bool(upsert_keys) and self.dbconn.autocommit
+            if explicit:
+                cursor.execute('BEGIN')
+            try:
+                if upsert_keys:
+                    copy_target = pgsql.Identifier('pyutils_staging')
+                    cursor.execute(pgsql.SQL('CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP').format(
+                        copy_target, target))
+                copy = pgsql.SQL('COPY {} {} FROM STDIN WITH {}').format(copy_target, column_list, options)
+                self.log('[*] Copying rows into %s...' % table)
+                if isinstance(source, str):
+                    with CSVUtils.open_csv(source) as f:
+                        cursor.copy_expert(copy, f, chunk_size)
+                else:
+                    cursor.copy_expert(copy, source, chunk_size)
+                loaded = cursor.rowcount
+                if upsert_keys:
+                    loaded = self._merge_staging(cursor, target, copy_target, columns, upsert_keys)
+                    cursor.execute(pgsql.SQL('DROP TABLE {}').format(copy_target))
+            except Exception:
+                if explicit:
+                    cursor.execute('ROLLBACK')
+                raise
+            if explicit:
+                cursor.execute('COMMIT')
+        self._invalidate_tables([table])
+        if commit:
+            self.commit()
+        return loaded
+
+    def _merge_staging(self, cursor, target, staging, columns, upsert_keys):
+        """
+        Merge a staging table into its target with INSERT ... ON CONFLICT, keeping only the last row copied for each
+        key since ON CONFLICT DO UPDATE can't change the same row twice.
+        :param cursor: cursor to execute on
+        :param target: psycopg2.sql.Identifier of the target table
+        :param staging: psycopg2.sql.Identifier of the staging table
+        :param columns: list of column names to merge; default is every column of the staging table
+        :param upsert_keys: list of key columns of the target's unique constraint
+        :return: number of rows inserted or updated
+        """
+        if not columns:
+            cursor.execute(pgsql.SQL('SELECT * FROM {} LIMIT 0').format(staging))
+            columns = [column[0] for column in cursor.description]
+        column_list = pgsql.SQL(', ').join(map(pgsql.Identifier, columns))
+        keys = pgsql.SQL(', ').join(map(pgsql.Identifier, upsert_keys))
+        updates = [pgsql.SQL('{0} = EXCLUDED.{0}').format(pgsql.Identifier(c)) for c in columns if c not in upsert_keys]
+        if updates:
+            action = pgsql.SQL('DO UPDATE SET {}').format(pgsql.SQL(', ').join(updates))
+        else:
+            action = pgsql.SQL('DO NOTHING')
+        # the staging table is only ever appended to, so ctid follows the order the rows were copied in
+        cursor.execute(pgsql.SQL('INSERT INTO {0} ({1}) SELECT DISTINCT ON ({3}) {1} FROM {2} ORDER BY {3}, ctid DESC '
+                                 'ON CONFLICT ({3}) {4}').format(target, column_list, staging, keys, action))
+        return cursor.rowcount
+
+
+class _PooledConnection(object):
+    """Bookkeeping for one connection held by a PGConnectionPool."""
+
+    def __init__(self, dbconn):
+        self.dbconn = dbconn
+        self.uses = 0
+        self.last_used = time.time()
+        self.checked_out = None
+        # prepared statements live on the server connection, so their cache has to follow the connection
+        self.prepared = OrderedDict()
+
+
+class PGConnectionPool(AbstractLogUtils):
+    """Thread-safe pool of PostgreSQL connections handed out with context managers."""
+
+    def __init__(self, conf_data, min_connections=1, max_connections=10, max_uses=1000, check_idle=30, timeout=30,
+                 schema=None, verbose=True, query_cache=None):
+        """
+        Initialize class.
+        :param conf_data: configuration data to initialize database connections
+        :param min_connections: number of connections opened up front
+        :param max_connections: maximum number of connections open at once
+        :param max_uses: number of checkouts after which a connection is closed and replaced
+        :param check_idle: seconds a connection may sit idle before it is checked with SELECT 1 on checkout
+        :param timeout: seconds to wait for a free connection before raising RuntimeError; None waits forever
+        :param schema: database schema location passed on to PGUtils objects from utils()
+        :param verbose: whether or not to print log messages
+        :param query_cache: optional QueryCache object shared by the PGUtils objects from utils()
+        """
+        AbstractLogUtils.__init__(self, verbose)
+        self.conf_data = conf_data
+        self.query_cache = query_cache
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.max_uses = max_uses
+        self.check_idle = check_idle
+        self.timeout = timeout
+        self.schema = schema
+        self.condition = threading.Condition()
+        self.idle = []
+        self.size = 0
+        self.in_use = 0
+        self.closed = False
+        self.started = time.time()
+        self.counters = {'checkouts': 0, 'created': 0, 'recycled': 0, 'failed_checks': 0, 'timeouts': 0,
+                         'wait_seconds': 0.0, 'max_wait_seconds': 0.0, 'busy_seconds': 0.0, 'peak_in_use': 0}
+        self.log("[*] Opening %d database connections..." % min_connections)
+        for _ in range(min_connections):
+            self.idle.append(self._connect())
+            self.size += 1
+
+    def _connect(self):
+        """
+        Open a new connection.
+        :return: _PooledConnection object
+        """
+        record = _PooledConnection(psycopg2.connect(**self.conf_data["DB_CONN_INFO"]))
+        with self.condition:
+            self.counters['created'] += 1
+        return record
+
+    def _healthy(self, record):
+        """
+        Check that an idle connection is still usable.
+        :param record: _PooledConnection object
+        :return: True if the connection can be handed out, False otherwise
+        """
+        if record.dbconn.closed:
+            return False
+        if time.time() - record.last_used < self.check_idle:
+            return True
+        try:
+            with record.dbconn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            record.dbconn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _checkout(self):
+        """
+        Take a connection from the pool, opening one if below max_connections or waiting for one to be returned.
+        :return: _PooledConnection object
+        """
+        start = time.time()
+        record = None
+        with self.condition:
+            while True:
+                if self.closed:
+                    raise RuntimeError('Connection pool is closed!')
+                if self.idle:
+                    record = self.idle.pop()
+                    break
+                if self.size < self.max_connections:
+                    # reserve the slot now and connect outside the lock
+                    self.size += 1
+                    break
+                remaining = None if self.timeout is None else start + self.timeout - time.time()
+                if remaining is not None and remaining <= 0:
+                    self.counters['timeouts'] += 1
+                    raise RuntimeError('Timed out waiting for a database connection!')
+                self.condition.wait(remaining)
+            waited = time.time() - start
+            self.in_use += 1
+            self.counters['checkouts'] += 1
+            self.counters['wait_seconds'] += waited
+            self.counters['max_wait_seconds'] = max(self.counters['max_wait_seconds'], waited)
+            self.counters['peak_in_use'] = max(self.counters['peak_in_use'], self.in_use)
+        try:
+            if record is not None and not self._healthy(record):
+                with self.condition:
+                    self.counters['failed_checks'] += 1
+                record.dbconn.close()
+                record = None
+            if record is None:
+                record = self._connect()
+        except Exception:
+            with self.condition:
+                self.size -= 1
+                self.in_use -= 1
+                self.condition.notify()
+            raise
+        record.checked_out = time.time()
+        return record
+
+    def _checkin(self, record):
+        """
+        Return a connection to the pool, closing it instead if it is broken or has been used max_uses times.
+        :param record: _PooledConnection object
+        :return: None
+        """
+        now = time.time()
+        record.uses += 1
+        record.last_used = now
+        discard = record.dbconn.closed or record.uses >= self.max_uses
+        with self.condition:
+            self.in_use -= 1
+            self.counters['busy_seconds'] += now - record.checked_out
+            if discard or self.closed:
+                self.size -= 1
+                if not record.dbconn.closed:
+                    self.counters['recycled'] += 1
+            else:
+                self.idle.append(record)
+            self.condition.notify()
+        if discard or self.closed:
+            if not record.dbconn.closed:
+                record.dbconn.close()
+
+    @contextmanager
+    def _checked_out(self):
+        """
+        Check out a connection for the duration of a with block, committing on success and rolling back on error.
+        :return: context manager yielding a _PooledConnection object
+        """
+        record = self._checkout()
+        committed = False
+        try:
+            yield record
+            if not record.dbconn.closed:
+                record.dbconn.commit()
+            committed = True
+        finally:
+            # also covers GeneratorExit and KeyboardInterrupt, so an abandoned block never leaves an open
+            # transaction for the next checkout to commit
+            if not committed and not record.dbconn.closed:
+                try:
+                    record.dbconn.rollback()
+                except psycopg2.Error:
+                    record.dbconn.close()
+            self._checkin(record)
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a raw connection; the transaction is committed when the block ends, or rolled back on an exception.
+        :return: context manager yielding a psycopg2 connection object
+        """
+        with self._checked_out() as record:
+            yield record.dbconn
+
+    @contextmanager
+    def cursor(self):
+        """
+        Check out a connection and open a cursor on it for the duration of the block.
+        :return: context manager yielding a psycopg2 cursor object
+        """
+        with self._checked_out() as record:
+            with record.dbconn.cursor() as cursor:
+                yield cursor
+
+    @contextmanager
+    def utils(self):
+        """
+        Check out a connection wrapped in a PGUtils object, with its own cursor, so all PGUtils methods can be used.
+        :return: context manager yielding a PGUtils object
+        """
+        with self._checked_out() as record:
+            db = PGUtils(self.conf_data, self.schema, verbose=self.verbose, dbconn=record.dbconn,
+                         query_cache=self.query_cache)
+            db.prepared = record.prepared
+            try:
+                yield db
+                if not db.dbconn.closed:
+                    # commit through the PGUtils object so the tables it wrote are invalidated once visible
+                    db.commit()
+            finally:
+                db.cursor.close()
+
+    def stats(self):
+        """
+        Get pool usage statistics.
+        :return: dictionary of counters plus size, idle, in_use, average wait time and utilization (the share of the
+            pool's maximum connection-time spent checked out)
+        """
+        with self.condition:
+            stats = dict(self.counters)
+            stats.update({'size': self.size, 'idle': len(self.idle), 'in_use': self.in_use})
+        elapsed = time.time() - self.started
+        stats['avg_wait_seconds'] = stats['wait_seconds'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        stats['utilization'] = stats['busy_seconds'] / (elapsed * self.max_connections) if elapsed else 0.0
+        return stats
+
+    def close(self):
+        """
+        Close all idle connections; connections still checked out are closed when they are returned.
+        :return: None
+        """
+        self.log("[*] Closing database connection pool...")
+        with self.condition:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.size -= len(idle)
+            self.condition.notify_all()
+        for record in idle:
+            record.dbconn.close()
@@ -1,5 +1,325 @@
+from collections import OrderedDict
+from contextlib import contextmanager
 from mcneelat.pyutils.confutils import AbstractLogUtils
 import ldap
+from ldap.controls import SimplePagedResultsControl
+from ldap.filter import escape_filter_chars
+import threading
+import time
+
+
+class _PooledLDAPConnection(object):
+    """Bookkeeping for one connection held by an LDAPConnectionPool."""
+
+    def __init__(self, con):
+        self.con = con
+        self.uses = 0
+        self.last_used = time.time()
+        self.broken = False
+
+
+class LDAPConnectionPool(AbstractLogUtils):
+    """Thread-safe pool of persistent, service account bound LDAP connections handed out with context managers."""
+
+    """Errors after which a connection can't be trusted and is re-initialized instead of returned to the pool."""
+    connection_errors = (ldap.SERVER_DOWN, ldap.UNAVAILABLE, ldap.CONNECT_ERROR, ldap.TIMEOUT)
+
+    def __init__(self, conf_data, size=4, timeout=30, check_idle=60, verbose=True):
+        """
+        Initialize class.
+        :param conf_data: dictionary containing LDAP_CONN_INFO and LDAP_SERVICE_ACCOUNT configuration
+        :param size: maximum number of connections kept open
+        :param timeout: seconds to wait for a free connection before raising RuntimeError; None waits forever
+        :param check_idle: seconds a connection may sit idle before it is checked with a WHOAMI on checkout
+        :param verbose: whether or not to print log messages
+        """
+        AbstractLogUtils.__init__(self, verbose)
+        self.conf_data = conf_data
+        self.size = size
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.condition = threading.Condition()
+        self.idle = []
+        self.open = 0
+        self.closed = False
+        self.counters = {'checkouts': 0, 'reused': 0, 'created': 0, 'rebinds': 0, 'reinitialized': 0,
+                         'user_binds': 0, 'failed_user_binds': 0, 'wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+
+    def _count(self, key, amount=1):
+        with self.condition:
+            self.counters[key] += amount
+
+    def _bind_service_account(self, con):
+        """
+        Bind a connection as the service account.
+        :param con: LDAP connection object
+        :return: None
+        """
+        con.simple_bind_s(self.conf_data['LDAP_SERVICE_ACCOUNT']['dn'],
+                          self.conf_data['LDAP_SERVICE_ACCOUNT']['password'])
+
+    def _connect(self):
+        """
+        Open and bind a new connection.
+        :return: _PooledLDAPConnection object
+        """
+        self.log('[*] Opening pooled LDAP connection as %s...' % self.conf_data['LDAP_SERVICE_ACCOUNT']['dn'])
+        con = ldap.initialize(self.conf_data['LDAP_CONN_INFO']['server'])
+        try:
+            self._bind_service_account(con)
+        except ldap.LDAPError:
+            self._unbind(con)
+            raise
+        self._count('created')
+        return _PooledLDAPConnection(con)
+
+    @staticmethod
+    def _unbind(con):
+        """
+        Close a connection, ignoring errors from one that is already dead.
+        :param con: LDAP connection object
+        :return: None
+        """
+        try:
+            con.unbind_s()
+        except ldap.LDAPError:
+            pass
+
+    def _revive(self, record):
+        """
+        Make sure an idle connection still works: check it if it has been idle a while, re-bind it if the check
+        fails, and re-initialize it if that fails too.
+        :param record: _PooledLDAPConnection object
+        :return: usable _PooledLDAPConnection object
+        """
+        # broken connections are unbound by _checkin, so only connections that worked when returned get here
+        if time.time() - record.last_used < self.check_idle:
+            return record
+        try:
+            record.con.whoami_s()
+            return record
+        except ldap.LDAPError:
+            pass
+        try:
+            self._bind_service_account(record.con)
+            self._count('rebinds')
+            return record
+        except ldap.LDAPError:
+            pass
+        self._unbind(record.con)
+        self._count('reinitialized')
+        return self._connect()
+
+    def _checkout(self):
+        """
+        Take a connection from the pool, opening one if fewer than size are open or waiting for one to be returned.
+        :return: _PooledLDAPConnection object
+        """
+        start = time.time()
+        record = None
+        with self.condition:
+            while True:
+                if self.closed:
+                    raise RuntimeError('LDAP connection pool is closed!')
+                if self.idle:
+                    record = self.idle.pop()
+                    break
+                if self.open < self.size:
+                    # reserve the slot now and connect outside the lock
+                    self.open += 1
+                    break
+                remaining = None if self.timeout is None else start + self.timeout - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise RuntimeError('Timed out waiting for an LDAP connection!')
+                self.condition.wait(remaining)
+            waited = time.time() - start
+            self.counters['checkouts'] += 1
+            self.counters['wait_seconds'] += waited
+            self.counters['max_wait_seconds'] = max(self.counters['max_wait_seconds'], waited)
+            if record is not None:
+                self.counters['reused'] += 1
+        try:
+            return self._connect() if record is None else self._revive(record)
+        except Exception:
+            with self.condition:
+                self.open -= 1
+                self.condition.notify()
+            raise
+
+    def _checkin(self, record):
+        """
+        Return a connection to the pool, or close it if it is broken or the pool is closed.
+        :param record: _PooledLDAPConnection object
+        :return: None
+        """
+        record.uses += 1
+        record.last_used = time.time()
+        with self.condition:
+            keep = not record.broken and not self.closed
+            if keep:
+                self.idle.append(record)
+            else:
+                self.open -= 1
+            self.condition.notify()
+        if not keep:
+            self._unbind(record.con)
+
+    @contextmanager
+    def connection(self):
+        """
+        Check out a service account bound connection for the duration of a with block.
+        :return: context manager yielding an LDAP connection object
+        """
+        record = self._checkout()
+        try:
+            yield record.con
+        except self.connection_errors:
+            record.broken = True
+            raise
+        finally:
+            self._checkin(record)
+
+    @contextmanager
+    def user_connection(self, dn, password):
+        """
+        Check out a connection and bind it as a user for the duration of a with block; afterwards it is bound back
+        to the service account before it is returned to the pool.
+        :param dn: user DN
+        :param password: user password
+        :return: context manager yielding an LDAP connection object bound as the user
+        """
+        record = self._checkout()
+        try:
+            try:
+                record.con.simple_bind_s(dn, password)
+            except ldap.LDAPError:
+                self._count('failed_user_binds')
+                raise
+            self._count('user_binds')
+            yield record.con
+        except self.connection_errors:
+            record.broken = True
+            raise
+        finally:
+            if not record.broken:
+                try:
+                    self._bind_service_account(record.con)
+                except ldap.LDAPError:
+                    record.broken = True
+            self._checkin(record)
+
+    def stats(self):
+        """
+        Get pool usage statistics.
+        :return: dictionary of counters plus open and idle connections, average wait time and reuse ratio
+        """
+        with self.condition:
+            stats = dict(self.counters)
+            stats.update({'open': self.open, 'idle': len(self.idle)})
+        stats['avg_wait_seconds'] = stats['wait_seconds'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        stats['reuse_ratio'] = stats['reused'] / float(stats['checkouts']) if stats['checkouts'] else 0.0
+        return stats
+
+    def close(self):
+        """
+        Unbind all idle connections; connections still checked out are unbound when they are returned.
+        :return: None
+        """
+        self.log('[*] Closing LDAP connection pool...')
+        with self.condition:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.open -= len(idle)
+            self.condition.notify_all()
+        for record in idle:
+            self._unbind(record.con)
+
+
+class UserDetailsCache(object):
+    """Thread-safe LRU cache of user details keyed by employee ID, with a shorter TTL for users not found."""
+
+    def __init__(self, max_entries=10000, ttl=300, negative_ttl=30):
+        """
+        Initialize class.
+        :param max_entries: maximum number of users cached before the least recently used is evicted
+        :param ttl: seconds the details of an active user are cached
+        :param negative_ttl: seconds a user that was not found or not active is cached as False
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        # employee ID -> (expiration time, attribute names retrieved or None for all, details or False)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, employeeid, attributes=None):
+        """
+        Look up a user, counting a hit or a miss; cached details only count if they include every attribute asked for.
+        :param employeeid: user employee ID
+        :param attributes: list of attribute names needed, or None for all attributes
+        :return: tuple of (True, details or False) on a hit, (False, None) otherwise
+        """
+        key = str(employeeid)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                del self.entries[key]
+                entry = None
+            if entry is None or (entry[2] is not False and entry[1] is not None and
+                                 (attributes is None or not entry[1].issuperset(attributes))):
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[2]
+
+    def put(self, employeeid, details, attributes=None):
+        """
+        Cache a user's details, or False for a user that was not found or not active.
+        :param employeeid: user employee ID
+        :param details: dictionary with user details or False
+        :param attributes: list of attribute names the details were retrieved with, or None for all attributes
+        :return: None
+        """
+        ttl = self.ttl if details is not False else self.negative_ttl
+        attributes = None if attributes is None else frozenset(attributes)
+        with self.lock:
+            self.entries[str(employeeid)] = (time.time() + ttl, attributes, details)
+            self.entries.move_to_end(str(employeeid))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *employeeids):
+        """
+        Drop cached users, i.e. after their status changes.
+        :param employeeids: user employee IDs
+        :return: number of users dropped
+        """
+        with self.lock:
+            return sum(1 for e in employeeids if self.entries.pop(str(e), None) is not None)
+
+    def clear(self):
+        """
+        Drop every cached user.
+        :return: None
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        """
+        Get cache statistics.
+        :return: dictionary of hits, misses, hit_ratio, entries and evictions
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_ratio': self.hits / float(lookups) if lookups else 0.0, 'entries': len(self.entries),
+                    'evictions': self.evictions}
 
 
 class DirectoryActions(AbstractLogUtils):
@@ -7,15 +327,26 @@ class DirectoryActions(AbstractLogUtils):
     Class containing methods to work with an LDAP server to perform login actions and resolve details about users.
     """
 
-    def __init__(self, conf_data, verbose=True):
+    """Number of employee IDs combined into each OR filter by get_userdetails."""
+    batch_size = 200
+
+    def __init__(self, conf_data, verbose=True, pool_size=0, user_cache=None, **pool_options):
         """
         Constructor.
         :param conf_data: dictionary containing configuration data for the app
         :param verbose: whether or not to print log messages
+        :param pool_size: if positive, keep this many persistent connections in an LDAPConnectionPool for login and
+            connection instead of connecting and binding on every call
+        :param user_cache: optional UserDetailsCache object that login refreshes and userdetails reads through
+        :param pool_options: other LDAPConnectionPool options (i.e. timeout, check_idle)
         """
         ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
         self.conf_data = conf_data
+        self.user_cache = user_cache
         AbstractLogUtils.__init__(self, verbose)
+        self.pool = None
+        if pool_size:
+            self.pool = LDAPConnectionPool(conf_data, pool_size, verbose=verbose, **pool_options)
 
     def login(self, employeeid, password):
         """
@@ -25,16 +356,52 @@ class DirectoryActions(AbstractLogUtils):
         :return: either details of user or False on failure
         """
         self.log('[*] Attempting login with ID %s...' % employeeid)
-        con = ldap.initialize(self.conf_data['LDAP_CONN_INFO']['server'])
         dn = self.conf_data['LDAP_CONN_INFO']['dn_base'] % employeeid
+        if self.pool is not None:
+            try:
+                with self.pool.user_connection(dn, password) as con:
+                    return self._login_details(con, employeeid)
+            except (ldap.LDAPError, RuntimeError) as error_message:
+                # RuntimeError is the pool timing out or being closed
+                print(error_message)
+                return False
+        con = ldap.initialize(self.conf_data['LDAP_CONN_INFO']['server'])
         try:
             con.simple_bind_s(dn, password)
-            return DirectoryActions.get_userdetails(con, employeeid)
+            return self._login_details(con, employeeid)
         except ldap.LDAPError as error_message:
             print(error_message)
             # return "Failed login on bind: dn=%s, pass=%s, error_message=%s" % (dn, password, error_message)
             return False
 
+    def _login_details(self, con, employeeid):
+        """
+        Get a logged in user's details straight from the directory, refreshing the user cache if there is one.
+        :param con: LDAP connection object bound as the user
+        :param employeeid: user employee ID
+        :return: dictionary with user details or False
+        """
+        if self.user_cache is not None:
+            self.user_cache.invalidate(employeeid)
+        return DirectoryActions.get_userdetails(con, employeeid, cache=self.user_cache, read_cache=False)
+
+    def userdetails(self, employeeid, attributes=None):
+        """
+        Get details about one or many users through the user cache, using a service account connection only for
+        users not cached.
+        :param employeeid: user employee ID, or a list of user employee IDs
+        :param attributes: list of attribute names to retrieve; default is all attributes
+        :return: as for get_userdetails
+        """
+        single = not isinstance(employeeid, (list, tuple, set))
+        if self.user_cache is not None and single:
+            hit, details = self.user_cache.get(employeeid, attributes)
+            if hit:
+                return details
+        with self.connection() as con:
+            # a single ID was just looked up in the cache above
+            return DirectoryActions.get_userdetails(con, employeeid, attributes, self.user_cache, read_cache=not single)
+
     def service_account_login(self):
         """
         Log into the LDAP server using a service account, which will allow us to search instead of only log in.
@@ -50,49 +417,133 @@ class DirectoryActions(AbstractLogUtils):
             print(error_message)
             return False
 
+    @contextmanager
+    def connection(self):
+        """
+        Get a service account bound connection for the duration of a with block, from the pool if there is one.
+        :return: context manager yielding an LDAP connection object
+        """
+        if self.pool is not None:
+            with self.pool.connection() as con:
+                yield con
+            return
+        con = self.service_account_login()
+        if con is False:
+            raise RuntimeError('Service account login failed!')
+        try:
+            yield con
+        finally:
+            con.unbind_s()
+
+    @staticmethod
+    def search_iter(con, search_term, attributes=None, base='', page_size=500, timeout=-1):
+        """
+        Search an LDAP connection one page at a time with the Simple Paged Results control, waiting for each page
+        rather than polling for it.
+        :param con: LDAP server connection object
+        :param search_term: LDAP filter
+        :param attributes: list of attribute names to retrieve; default is all attributes
+        :param base: search base DN
+        :param page_size: number of entries the server returns per page
+        :param timeout: seconds to wait for each page; -1 waits forever
+        :return: generator of (dn, attribute dictionary) tuples
+        """
+        page_control = SimplePagedResultsControl(True, size=page_size, cookie='')
+        while True:
+            msgid = con.search_ext(base, ldap.SCOPE_SUBTREE, search_term, attributes, serverctrls=[page_control])
+            _, result_data, _, server_controls = con.result3(msgid, timeout=timeout)
+            for dn, entry in result_data:
+                # referrals come back without a DN
+                if dn is not None:
+                    yield dn, entry
+            cookie = None
+            for control in server_controls:
+                if control.controlType == SimplePagedResultsControl.controlType:
+                    cookie = control.cookie
+            if not cookie:
+                break
+            page_control.cookie = cookie
+
     @staticmethod
-    def search(con, search_term):
+    def search(con, search_term, attributes=None):
         """
         Generic search method against an LDAP connection.
         :param con: LDAP server connection object
         :param search_term: search term
+        :param attributes: list of attribute names to retrieve; default is all attributes
         :return: dictionary of LDAP search results
         """
-        base = ''
-        scope = ldap.SCOPE_SUBTREE
-        retrieve_attributes = None
-        result_set = []
-        timeout = 0
         try:
-            result_id = con.search(base, scope, search_term, retrieve_attributes)
-            while True:
-                result_type, result_data = con.result(result_id, timeout)
-                if result_data is []:
-                    break
-                else:
-                    if result_type == ldap.RES_SEARCH_ENTRY:
-                        result_set.append(result_data)
-            if len(result_set) == 0:
-                print("Empty result set: search-term=%s" % search_term)
-                # return "Empty result set: search-term=%s" % search_term
-                return False
-            return result_set[0][0][1]
+            for _, entry in DirectoryActions.search_iter(con, search_term, attributes):
+                return entry
+            print("Empty result set: search-term=%s" % search_term)
+            # return "Empty result set: search-term=%s" % search_term
+            return False
         except ldap.LDAPError as error_message:
             print(error_message)
             # return error_message
             return False
 
     @staticmethod
-    def get_userdetails(con, employeeid):
+    def _is_active(details):
+        """
+        Check the employeeStatus of a user's details.
+        :param details: dictionary with user details
+        :return: True if the user is active, False otherwise
         """
-        Get details about the user with the specified employee ID.
+        status = details.get('employeeStatus', [None])[0]
+        return status in ('Active', b'Active')
+
+    @staticmethod
+    def get_userdetails(con, employeeid, attributes=None, cache=None, read_cache=True):
+        """
+        Get details about the user with the specified employee ID, or about many users at once with one OR filter
+        query per batch of IDs.
         :param con: LDAP server connection object
-        :param employeeid: user employee ID
-        :return: dictionary with user details or false on failure
+        :param employeeid: user employee ID, or a list of user employee IDs
+        :param attributes: list of attribute names to retrieve; default is all attributes
+        :param cache: optional UserDetailsCache object; cached users are not searched for, and the results of
+            successful searches (including users not found or not active) are cached
+        :param read_cache: whether or not to look users up in the cache before searching; False when the caller
+            already has, so each lookup counts only once in the cache's hits and misses, or to force a refresh
+        :return: dictionary with user details or false on failure; for a list of IDs, a dictionary of each employee
+            ID to its details or False
         """
-        dir_result = DirectoryActions.search(con, "cn=%s" % employeeid)
-        if not dir_result:
-            return False
-        if dir_result['employeeStatus'][0] != 'Active':
-            return False
-        return dir_result
+        if attributes is not None:
+            attributes = list(set(attributes) | {'cn', 'employeeStatus'})
+        single = not isinstance(employeeid, (list, tuple, set))
+        employeeids = [str(employeeid)] if single else [str(e) for e in employeeid]
+        results = dict((e, False) for e in employeeids)
+        missing = []
+        for e in employeeids:
+            hit, details = cache.get(e, attributes) if cache is not None and read_cache else (False, None)
+            if hit:
+                results[e] = details
+            else:
+                missing.append(e)
+        for i in range(0, len(missing), DirectoryActions.batch_size):
+            batch = missing[i:i + DirectoryActions.batch_size]
+            if single:
+                search_term = 'cn=%s' % escape_filter_chars(batch[0])
+            else:
+                search_term = '(|%s)' % ''.join('(cn=%s)' % escape_filter_chars(e) for e in batch)
+            found = {}
+            try:
+                for _, entry in DirectoryActions.search_iter(con, search_term, attributes):
+                    if single:
+                        found[batch[0]] = entry
+                        break
+                    for cn in entry.get('cn', ()):
+                        found[cn.decode('utf-8') if isinstance(cn, bytes) else cn] = entry
+            except ldap.LDAPError as error_message:
+                # don't cache anything from a failed search
+                print(error_message)
+                continue
+            if single and not found:
+                print("Empty result set: search-term=%s" % search_term)
+            for e in batch:
+                entry = found.get(e)
+                results[e] = entry if entry is not None and DirectoryActions._is_active(entry) else False
+                if cache is not None:
+                    cache.put(e, results[e], attributes)
+        return results[employeeids[0]] if single else results
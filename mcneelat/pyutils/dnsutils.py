@@ -1,17 +1,249 @@
+import base64
+from collections import deque, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import csv
+import dns.message
 import dns.resolver
+import json
+from mcneelat.pyutils.netutils import IPSet, PyNetAddr
+import os
 import re
+import threading
+import time
+
+_ip_pattern = re.compile(r'^\d{1,3}(\.\d{1,3}){3}$')
+
+
+class _NameserverSlots(object):
+    """Per-nameserver concurrency limits; each query takes a slot on the least busy nameserver."""
+
+    def __init__(self, nameservers, limit):
+        """
+        Initialize class.
+        :param nameservers: list of nameservers
+        :param limit: maximum number of concurrent queries per nameserver
+        """
+        self.limit = limit
+        self.in_use = dict((nameserver, 0) for nameserver in nameservers)
+        self.condition = threading.Condition()
+
+    def acquire(self, avoid=()):
+        """
+        Wait for a free slot, preferring nameservers not in avoid (i.e. ones that already failed this query).
+        :param avoid: collection of nameservers to use only if no other has a free slot
+        :return: nameserver
+        """
+        with self.condition:
+            while True:
+                free = [(nameserver in avoid, count, nameserver) for nameserver, count in self.in_use.items()
+                        if count < self.limit]
+                if free:
+                    nameserver = min(free)[2]
+                    self.in_use[nameserver] += 1
+                    return nameserver
+                self.condition.wait()
+
+    def release(self, nameserver):
+        """
+        Free a slot taken with acquire.
+        :param nameserver: nameserver returned by acquire
+        :return: None
+        """
+        with self.condition:
+            self.in_use[nameserver] -= 1
+            self.condition.notify()
+
+
+class DNSCache(object):
+    """Thread-safe LRU cache of DNS answers keyed by (name, qtype) that honours record TTLs and caches failures."""
+
+    def __init__(self, max_entries=100000, min_ttl=5, max_ttl=86400, negative_ttl=300, persist_file=None):
+        """
+        Initialize class.
+        :param max_entries: maximum number of cached answers before the least recently used is evicted
+        :param min_ttl: minimum number of seconds any answer is cached, however low its TTL
+        :param max_ttl: maximum number of seconds any answer is cached, however high its TTL
+        :param negative_ttl: seconds NXDOMAIN and NoAnswer responses are cached when they carry no SOA record
+        :param persist_file: optional JSON file the cache is loaded from now and written to by save
+        """
+        self.max_entries = max_entries
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.persist_file = persist_file
+        self.lock = threading.Lock()
+        # (name, qtype) -> (expiration time, dns.resolver.Answer or False)
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if persist_file and os.path.isfile(persist_file):
+            self.load(persist_file)
+
+    @staticmethod
+    def make_key(name, qtype):
+        """
+        Normalize a query into a cache key.
+        :param name: domain name
+        :param qtype: record type
+        :return: tuple of (name, qtype)
+        """
+        return name.lower().rstrip('.'), qtype.upper()
+
+    def clamp(self, ttl):
+        """
+        Clamp a TTL between min_ttl and max_ttl.
+        :param ttl: TTL in seconds
+        :return: clamped TTL
+        """
+        return max(self.min_ttl, min(self.max_ttl, ttl))
+
+    def get(self, name, qtype):
+        """
+        Look up a cached answer, counting a hit or a miss.
+        :param name: domain name
+        :param qtype: record type
+        :return: tuple of (True, dns.resolver.Answer or False for a cached failure) on a hit, (False, None) otherwise
+        """
+        key = self.make_key(name, qtype)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] <= time.time():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            if entry[1] is False:
+                self.negative_hits += 1
+            return True, entry[1]
+
+    def put(self, name, qtype, answer):
+        """
+        Cache an answer for its clamped TTL, which is the lowest TTL along its CNAME chain.
+        :param name: domain name
+        :param qtype: record type
+        :param answer: dns.resolver.Answer object
+        :return: None
+        """
+        now = time.time()
+        self._store(self.make_key(name, qtype), now + self.clamp(answer.expiration - now), answer)
+
+    def put_negative(self, name, qtype, error):
+        """
+        Cache an NXDOMAIN or NoAnswer response for the negative TTL from its SOA record (the lower of the SOA's TTL
+        and minimum field), or negative_ttl if there is none.
+        :param name: domain name
+        :param qtype: record type
+        :param error: dns.resolver.NXDOMAIN or dns.resolver.NoAnswer exception
+        :return: None
+        """
+        if isinstance(error, dns.resolver.NXDOMAIN):
+            responses = list(error.responses().values())
+        else:
+            # dnspython 1.16 has no NoAnswer.response(), but both versions keep the response in kwargs
+            responses = [error.kwargs.get('response')]
+        ttl = self.negative_ttl
+        for response in filter(None, responses):
+            for rrset in response.authority:
+                if rrset.rdtype == dns.rdatatype.SOA:
+                    ttl = min(rrset.ttl, rrset[0].minimum)
+                    break
+        self._store(self.make_key(name, qtype), time.time() + self.clamp(ttl), False)
+
+    def _store(self, key, expiration, value):
+        """
+        Store an entry, evicting the least recently used entries beyond max_entries.
+        :param key: key from make_key
+        :param expiration: time the entry expires
+        :param value: dns.resolver.Answer or False
+        :return: None
+        """
+        with self.lock:
+            self.entries[key] = (expiration, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Drop every cached answer.
+        :return: None
+        """
+        with self.lock:
+            self.entries.clear()
+
+    def save(self, persist_file=None):
+        """
+        Write the unexpired entries to a JSON file (answers in DNS wire format), replacing it atomically.
+        :param persist_file: file to write; default is the file given when the cache was created
+        :return: number of entries written
+        """
+        persist_file = persist_file or self.persist_file
+        now = time.time()
+        with self.lock:
+            entries = [(key, value) for key, value in self.entries.items() if value[0] > now]
+        records = []
+        for (name, qtype), (expiration, answer) in entries:
+            wire = None
+            if answer is not False:
+                wire = base64.b64encode(answer.response.to_wire()).decode('ascii')
+            records.append({'name': name, 'qtype': qtype, 'expiration': expiration, 'response': wire})
+        with open(persist_file + '.tmp', 'w') as f:
+            json.dump(records, f)
+        os.replace(persist_file + '.tmp', persist_file)
+        return len(records)
+
+    def load(self, persist_file=None):
+        """
+        Load the unexpired entries of a file written by save, i.e. to start warm after a restart.
+        :param persist_file: file to read; default is the file given when the cache was created
+        :return: number of entries loaded
+        """
+        with open(persist_file or self.persist_file, 'r') as f:
+            records = json.load(f)
+        now = time.time()
+        loaded = 0
+        for record in records:
+            if record['expiration'] <= now:
+                continue
+            answer = False
+            if record['response'] is not None:
+                response = dns.message.from_wire(base64.b64decode(record['response']))
+                question = response.question[0]
+                answer = dns.resolver.Answer(question.name, question.rdtype, question.rdclass, response)
+            self._store((record['name'], record['qtype']), record['expiration'], answer)
+            loaded += 1
+        return loaded
+
+    def stats(self):
+        """
+        Get cache statistics.
+        :return: dictionary of hits, negative_hits, misses, hit_ratio, entries and evictions
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'negative_hits': self.negative_hits, 'misses': self.misses,
+                    'hit_ratio': self.hits / lookups if lookups else 0.0, 'entries': len(self.entries),
+                    'evictions': self.evictions}
 
 
 class DNSResolver:
     """This class simplifies the process of performing a recursive DNS query against a nameserver."""
 
-    def __init__(self, nameservers=('8.8.8.8', '8.8.4.4')):
+    def __init__(self, nameservers=('8.8.8.8', '8.8.4.4'), cache=None):
         """
         Initialize class.
         :param nameservers: list of nameservers to query
+        :param cache: optional DNSCache object consulted before querying; it may be shared between resolvers
         """
         self.dns_resolver = dns.resolver.Resolver()
         self.dns_resolver.nameservers = nameservers
+        self.cache = cache
+        self.bulk_stats = {}
 
     def change_nameservers(self, nameservers):
         """
@@ -21,6 +253,19 @@ class DNSResolver:
         """
         self.dns_resolver.nameservers = nameservers
 
+    @staticmethod
+    def prepare_query(queryobj, qtype='A'):
+        """
+        Normalize a query, turning a dotted-quad IP address into an in-addr.arpa PTR query.
+        :param queryobj: domain name or IP address
+        :param qtype: type of record to search for
+        :return: tuple of (name, qtype)
+        """
+        queryobj = queryobj.strip()
+        if _ip_pattern.match(queryobj):
+            return '.'.join(reversed(queryobj.split('.'))) + ".in-addr.arpa", 'PTR'
+        return queryobj, qtype
+
     def lookup(self, queryobj, qtype='A'):
         """
         Perform a DNS query (by default we search for an 'A' record.)
@@ -28,11 +273,192 @@ class DNSResolver:
         :param qtype: type of record to search for; default is A
         :return: DNS response or False if no results
         """
-        if re.match(r'^\d{1,3}(\.\d{1,3}){3}$', queryobj.strip()):
-            queryobj = '.'.join(reversed(queryobj.split('.'))) + ".in-addr.arpa"
-            qtype = 'PTR'
+        queryobj, qtype = self.prepare_query(queryobj, qtype)
+        if self.cache is not None:
+            hit, answer = self.cache.get(queryobj, qtype)
+            if hit:
+                return answer
         try:
             answer = self.dns_resolver.query(queryobj, qtype)
+            if self.cache is not None:
+                self.cache.put(queryobj, qtype, answer)
             return answer
+        except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer) as e:
+            if self.cache is not None:
+                self.cache.put_negative(queryobj, qtype, e)
+            return False
         except dns.exception.DNSException:
             return False
+
+    def lookup_many(self, queries, qtype='A', per_nameserver=16, timeout=2.0, retries=1):
+        """
+        Resolve many names or IP addresses concurrently, spreading the queries over the nameservers with at most
+        per_nameserver queries in flight on each. Results are yielded as they complete, so their order is not the
+        input order. A query that times out or gets SERVFAIL (or REFUSED) is retried on another nameserver up to
+        retries times and then reported as False without holding up the rest. Answers are read from and added to
+        the cache when there is one. Running counters, including queries_per_second, are kept in self.bulk_stats.
+        :param queries: iterable of domain names and/or IP addresses; it is consumed lazily
+        :param qtype: type of record to search for; default is A (IP addresses always use PTR)
+        :param per_nameserver: maximum number of concurrent queries per nameserver
+        :param timeout: seconds to wait for each nameserver's answer
+        :param retries: number of times a timed out or failed query is retried
+        :return: generator of (query, DNS response or False) tuples
+        """
+        nameservers = list(self.dns_resolver.nameservers)
+        resolvers = {}
+        for nameserver in nameservers:
+            resolver = dns.resolver.Resolver(configure=False)
+            resolver.nameservers = [nameserver]
+            resolver.port = self.dns_resolver.port
+            resolver.timeout = resolver.lifetime = timeout
+            resolvers[nameserver] = resolver
+        slots = _NameserverSlots(nameservers, per_nameserver)
+        stats = self.bulk_stats = {'queries': 0, 'cached': 0, 'answered': 0, 'not_found': 0, 'timeouts': 0,
+                                   'servfail': 0, 'errors': 0, 'retries': 0, 'elapsed': 0.0, 'queries_per_second': 0.0}
+        lock = threading.Lock()
+
+        def count(key):
+            with lock:
+                stats[key] += 1
+
+        def resolve(queryobj):
+            name, rdtype = self.prepare_query(queryobj, qtype)
+            if self.cache is not None:
+                hit, answer = self.cache.get(name, rdtype)
+                if hit:
+                    count('cached')
+                    return queryobj, answer
+            tried = set()
+            for attempt in range(retries + 1):
+                if attempt:
+                    count('retries')
+                nameserver = slots.acquire(tried)
+                try:
+                    answer = resolvers[nameserver].query(name, rdtype)
+                    count('answered')
+                    if self.cache is not None:
+                        self.cache.put(name, rdtype, answer)
+                    return queryobj, answer
+                except (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer) as e:
+                    count('not_found')
+                    if self.cache is not None:
+                        self.cache.put_negative(name, rdtype, e)
+                    return queryobj, False
+                except dns.exception.Timeout:
+                    count('timeouts')
+                except dns.resolver.NoNameservers:
+                    count('servfail')
+                except dns.exception.DNSException:
+                    count('errors')
+                    return queryobj, False
+                finally:
+                    slots.release(nameserver)
+                tried.add(nameserver)
+            return queryobj, False
+
+        start = time.time()
+        window = per_nameserver * len(nameservers)
+        queries = iter(queries)
+        with ThreadPoolExecutor(window) as executor:
+            pending = set()
+            exhausted = False
+            while pending or not exhausted:
+                # keep twice the number of workers queued so the input is read lazily
+                while not exhausted and len(pending) < 2 * window:
+                    queryobj = next(queries, None)
+                    if queryobj is None:
+                        exhausted = True
+                    else:
+                        pending.add(executor.submit(resolve, queryobj))
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    stats['queries'] += 1
+                    stats['elapsed'] = time.time() - start
+                    stats['queries_per_second'] = stats['queries'] / stats['elapsed'] if stats['elapsed'] else 0.0
+                    yield result
+
+    def reverse_sweep(self, networks, callback=None, output_file=None, checkpoint_file=None, rate=None,
+                      per_nameserver=16, timeout=2.0, retries=1, checkpoint_every=1000):
+        """
+        Look up the PTR record of every address in one or more networks, enumerating the addresses lazily and
+        querying them concurrently through lookup_many. Each (ip, hostname) pair found is passed to callback and/or
+        appended to output_file as a CSV line. With a checkpoint file, progress is saved every checkpoint_every
+        addresses and an interrupted sweep of the same networks resumes after the last address before which every
+        query had finished; pairs found after that point may be reported again.
+        :param networks: PyNetAddr object, CIDR notation string, or list of either (overlaps are swept once)
+        :param callback: optional function called with (ip, hostname) for every PTR record found
+        :param output_file: optional CSV file the (ip, hostname) pairs are appended to
+        :param checkpoint_file: optional JSON file used to save and resume progress
+        :param rate: optional maximum number of queries per second
+        :param per_nameserver: maximum number of concurrent queries per nameserver
+        :param timeout: seconds to wait for each nameserver's answer
+        :param retries: number of times a timed out or failed query is retried
+        :param checkpoint_every: number of completed addresses between checkpoints
+        :return: dictionary of addresses queried, hostnames found, resumed_from address, and the lookup_many stats
+        """
+        if isinstance(networks, (str, PyNetAddr)):
+            networks = [networks]
+        ipset = IPSet(networks)
+        cidrs = ['%s/%d' % (cidr.network, cidr.cidr_mask) for cidr in ipset.cidrs()]
+        resume = None
+        if checkpoint_file and os.path.isfile(checkpoint_file):
+            with open(checkpoint_file, 'r') as f:
+                checkpoint = json.load(f)
+            if checkpoint['networks'] == cidrs:
+                resume = PyNetAddr.addr_to_int(checkpoint['done_through'])
+            else:
+                print("[*] Warning: checkpoint %s is for different networks, starting over" % checkpoint_file)
+        if resume is not None:
+            ipset = ipset - IPSet.from_ranges([(0, resume)])
+        # addresses handed to lookup_many, in order; the checkpoint only moves past addresses that all finished
+        submitted = deque()
+        finished = set()
+        state = {'done_through': resume, 'addresses': 0, 'found': 0}
+
+        def addresses():
+            start = time.time()
+            for sent, value in enumerate(ipset.iter_hosts(as_int=True)):
+                if rate:
+                    delay = start + sent / float(rate) - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                submitted.append(value)
+                yield PyNetAddr.int_to_addr(value)
+
+        def save_checkpoint():
+            if output is not None:
+                output.flush()
+            if checkpoint_file and state['done_through'] is not None:
+                with open(checkpoint_file + '.tmp', 'w') as f:
+                    json.dump({'networks': cidrs, 'done_through': PyNetAddr.int_to_addr(state['done_through'])}, f)
+                os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+        output = open(output_file, 'a', newline='') if output_file else None
+        writer = csv.writer(output) if output is not None else None
+        try:
+            for ip, answer in self.lookup_many(addresses(), 'PTR', per_nameserver, timeout, retries):
+                if answer:
+                    for record in answer:
+                        hostname = record.target.to_text().rstrip('.')
+                        state['found'] += 1
+                        if callback is not None:
+                            callback(ip, hostname)
+                        if writer is not None:
+                            writer.writerow((ip, hostname))
+                finished.add(PyNetAddr.addr_to_int(ip))
+                while submitted and submitted[0] in finished:
+                    state['done_through'] = submitted.popleft()
+                    finished.remove(state['done_through'])
+                state['addresses'] += 1
+                if state['addresses'] % checkpoint_every == 0:
+                    save_checkpoint()
+        finally:
+            save_checkpoint()
+            if output is not None:
+                output.close()
+        return {'addresses': state['addresses'], 'found': state['found'],
+                'resumed_from': None if resume is None else PyNetAddr.int_to_addr(resume),
+                'lookups': dict(self.bulk_stats)}
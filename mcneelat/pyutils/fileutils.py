@@ -1,12 +1,43 @@
+from array import array
+from bisect import bisect_right
+import bz2
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 import csv
+from fnmatch import fnmatchcase
+import gzip
+import hashlib
+import io
+from itertools import islice
+import json
+import lzma
+from operator import itemgetter
+import mmap
+from mcneelat.pyutils.netutils import PyNetAddr, PyNetAddrBatch
 import os
+import shutil
 import tarfile
+import threading
+import time
+import zlib
 from zipfile import is_zipfile, ZipFile
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 
 class CSVUtils:
     """This class simplifies the process of working with CSV files."""
 
+    """Map of Python types accepted as column converters to the typed array they produce."""
+    column_converters = {int: 'int', float: 'float'}
+
+    """Map of compressed file extensions to the function that opens them as a binary stream."""
+    compressed_openers = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open, '.lzma': lzma.open}
+
     def __init__(self):
         pass
 
@@ -14,75 +45,841 @@ class CSVUtils:
     def get_headers(infile):
         """
         Get a dictionary where k = header name, v = column index.
-        :param infile: CSV file to read from
+        :param infile: CSV file to read from; may be compressed or an (archive path, member name) tuple, see open_csv
         :return: dictionary where k = header name, v = column index
         """
-        headers_map = {}
-        with open(infile) as csvfile:
-            csvreader = csv.reader(csvfile)
-            for line in csvreader:
-                for i in range(len(line)):
-                    headers_map[line[i]] = i
-                break
-        return headers_map
+        with CSVUtils.open_csv(infile) as csvfile:
+            return CSVUtils._read_headers(csv.reader(csvfile))
+
+    @staticmethod
+    def is_compressed(infile):
+        """
+        Check whether a CSV input has to be decompressed as it is read.
+        :param infile: CSV file path, or (archive path, member name) tuple
+        :return: True if the input is an archive member or a compressed file, False otherwise
+        """
+        return isinstance(infile, tuple) or os.path.splitext(infile)[1].lower() in CSVUtils.compressed_openers
+
+    @staticmethod
+    @contextmanager
+    def open_csv(infile, buffer_size=1024 * 1024, encoding=None):
+        """
+        Open a CSV input as a text stream, decompressing it on the fly when needed so nothing is written to disk.
+        :param infile: CSV file path (.gz, .bz2, .xz and .lzma files are decompressed), or an (archive path, member
+            name) tuple to read a member of a tar or zip file
+        :param buffer_size: size in bytes of the read buffer
+        :param encoding: text encoding; default is the platform default, the same as open()
+        :return: context manager yielding a text file object suitable for csv.reader
+        """
+        to_close = []
+        try:
+            if isinstance(infile, tuple):
+                archive, member = infile
+                if is_zipfile(archive):
+                    container = ZipFile(archive, 'r')
+                    to_close.append(container)
+                    raw = container.open(member)
+                else:
+                    # iterate rather than getmember(), which would read every header in the archive first
+                    container = tarfile.open(archive, 'r:*')
+                    to_close.append(container)
+                    raw = None
+                    for tarinfo in container:
+                        if tarinfo.name == member:
+                            raw = container.extractfile(tarinfo)
+                            break
+                    if raw is None:
+                        raise KeyError('There is no item named %r in the archive' % member)
+            else:
+                opener = CSVUtils.compressed_openers.get(os.path.splitext(infile)[1].lower())
+                if opener is None:
+                    raw = io.open(infile, 'rb', buffering=buffer_size)
+                else:
+                    raw = opener(infile, 'rb')
+            to_close.append(raw)
+            if not isinstance(raw, io.BufferedReader):
+                raw = io.BufferedReader(raw, buffer_size)
+            csvfile = io.TextIOWrapper(raw, encoding=encoding, newline='')
+            # decode in large chunks rather than the default 8 KiB, so decompression isn't called per small read
+            csvfile._CHUNK_SIZE = buffer_size
+            to_close.append(csvfile)
+            yield csvfile
+        finally:
+            for f in reversed(to_close):
+                f.close()
 
     @staticmethod
     def read_csv(infile, has_headers=True, selected_columns=None):
         """
         Read all lines in a CSV file to a list of lists.
-        :param infile: CSV file to read from
+        :param infile: CSV file to read from; may be compressed or an (archive path, member name) tuple, see open_csv
         :param has_headers: whether or not the CSV file has a header line; default is True
         :param selected_columns: list of selected columns by either header name or index
         :return: tuple -- contents of CSV file as list of lists, headers dictionary
         """
-        headers_map = None
-        l1 = False
-        if has_headers:
-            headers_map = CSVUtils.get_headers(infile)
-            l1 = True
-        lines = []
-        with open(infile) as csvfile:
+        with CSVUtils.open_csv(infile) as csvfile:
             csvreader = csv.reader(csvfile)
+            headers_map = CSVUtils._read_headers(csvreader) if has_headers else None
+            lines = list(CSVUtils._iter_rows(csvreader, headers_map, selected_columns))
+        return lines, headers_map
+
+    @staticmethod
+    def read_csv_iter(infile, has_headers=True, selected_columns=None, as_tuples=False,
+                      buffer_size=1024 * 1024, offset=0, limit=None, encoding=None):
+        """
+        Lazily read lines in a CSV file, opening it only once and holding only one row in memory at a time.
+        :param infile: CSV file to read from; may be compressed or an (archive path, member name) tuple, see open_csv
+        :param has_headers: whether or not the CSV file has a header line; default is True
+        :param selected_columns: list of selected columns by either header name or index
+        :param as_tuples: yield tuples instead of lists
+        :param buffer_size: size in bytes of the file read buffer; default is 1 MiB
+        :param offset: number of non-empty data lines to skip before yielding
+        :param limit: maximum number of lines to yield; None for all
+        :param encoding: text encoding; default is the platform default
+        :return: generator of lines as lists (or tuples)
+        """
+        with CSVUtils.open_csv(infile, buffer_size, encoding) as csvfile:
+            csvreader = csv.reader(csvfile)
+            headers_map = CSVUtils._read_headers(csvreader) if has_headers else None
+            rows = CSVUtils._iter_rows(csvreader, headers_map, selected_columns, as_tuples)
+            if offset or limit is not None:
+                rows = islice(rows, offset, None if limit is None else offset + limit)
+            for row in rows:
+                yield row
+
+    @staticmethod
+    def read_csv_columns(infile, selected_columns, converters=None, has_headers=True, chunk_rows=1000000,
+                         use_numpy=None):
+        """
+        Read selected columns of a CSV file into one typed array per column.
+        :param infile: CSV file to read from; may be compressed or an (archive path, member name) tuple, see open_csv
+        :param selected_columns: list of selected columns by either header name or index
+        :param converters: dictionary where k = selected column, v = 'int', 'float', 'ipv4', int, float, or any callable
+            applied to each value; columns without a converter are kept as strings
+        :param has_headers: whether or not the CSV file has a header line; default is True
+        :param chunk_rows: number of lines converted at a time, which bounds the memory used for raw strings
+        :param use_numpy: build NumPy arrays if True, array.array objects (or lists) if False; default is to use NumPy
+            when it is installed
+        :return: dictionary where k = selected column, v = array of values
+        """
+        use_numpy = CSVUtils._want_numpy(use_numpy)
+        chunks = list(CSVUtils.iter_csv_columns(infile, selected_columns, converters, has_headers, chunk_rows,
+                                                use_numpy))
+        if not chunks:
+            return CSVUtils._convert_columns(selected_columns, [()] * len(selected_columns), converters, use_numpy)
+        columns = chunks[0]
+        for c in selected_columns:
+            if use_numpy:
+                columns[c] = np.concatenate([chunk[c] for chunk in chunks])
+            else:
+                for chunk in chunks[1:]:
+                    columns[c].extend(chunk[c])
+        return columns
+
+    @staticmethod
+    def iter_csv_columns(infile, selected_columns, converters=None, has_headers=True, chunk_rows=1000000,
+                         use_numpy=None):
+        """
+        Read selected columns of a CSV file as typed arrays, one chunk of lines at a time.
+        :param infile: CSV file to read from; may be compressed or an (archive path, member name) tuple, see open_csv
+        :param selected_columns: list of selected columns by either header name or index
+        :param converters: dictionary where k = selected column, v = 'int', 'float', 'ipv4', int, float, or any callable
+            applied to each value; columns without a converter are kept as strings
+        :param has_headers: whether or not the CSV file has a header line; default is True
+        :param chunk_rows: maximum number of lines per chunk
+        :param use_numpy: build NumPy arrays if True, array.array objects (or lists) if False; default is to use NumPy
+            when it is installed
+        :return: generator of dictionaries where k = selected column, v = array of values in the chunk
+        """
+        use_numpy = CSVUtils._want_numpy(use_numpy)
+        rows = CSVUtils.read_csv_iter(infile, has_headers, selected_columns, as_tuples=True)
+        while True:
+            chunk = list(islice(rows, chunk_rows))
+            if not chunk:
+                break
+            yield CSVUtils._convert_columns(selected_columns, list(zip(*chunk)), converters, use_numpy)
+            if len(chunk) < chunk_rows:
+                break
+
+    @staticmethod
+    def _want_numpy(use_numpy):
+        """
+        Decide whether or not to build NumPy arrays.
+        :param use_numpy: True, False, or None to use NumPy only if it is installed
+        :return: True if NumPy arrays should be built
+        """
+        if use_numpy is None:
+            return np is not None
+        if use_numpy and np is None:
+            raise ImportError('NumPy is required for use_numpy=True; install it with "pip install numpy"')
+        return use_numpy
+
+    @staticmethod
+    def _convert_columns(selected_columns, values, converters, use_numpy):
+        """
+        Convert columns of raw strings to typed arrays.
+        :param selected_columns: list of selected columns by either header name or index
+        :param values: list of sequences of strings, one per selected column
+        :param converters: dictionary where k = selected column, v = converter
+        :param use_numpy: build NumPy arrays if True, array.array objects (or lists) if False
+        :return: dictionary where k = selected column, v = array of values
+        """
+        converters = converters or {}
+        columns = {}
+        for c, column in zip(selected_columns, values):
+            converter = CSVUtils.column_converters.get(converters.get(c), converters.get(c))
+            if converter == 'ipv4':
+                if use_numpy:
+                    columns[c] = PyNetAddrBatch.parse(column)[0]
+                else:
+                    # invalid addresses (including a first octet of 0) become 0, the same as the NumPy path
+                    ints = (PyNetAddr.addr_to_int(v) or 0 for v in column)
+                    columns[c] = array('L', [v if v >> 24 else 0 for v in ints])
+            elif converter == 'int':
+                columns[c] = np.array(column, dtype=np.int64) if use_numpy else array('q', [int(v) for v in column])
+            elif converter == 'float':
+                columns[c] = np.array(column, dtype=np.float64) if use_numpy else array('d', [float(v) for v in column])
+            elif converter is None:
+                columns[c] = np.array(column, dtype=str) if use_numpy else list(column)
+            else:
+                converted = [converter(v) for v in column]
+                columns[c] = np.array(converted) if use_numpy else converted
+        return columns
+
+    @staticmethod
+    def read_csv_parallel(infile, has_headers=True, selected_columns=None, workers=None, chunk_size=64 * 1024 * 1024,
+                          ordered=True, encoding='utf-8'):
+        """
+        Read lines in a CSV file by parsing chunks of it in parallel across a pool of processes.
+        :param infile: CSV file to read from; compressed inputs and archive members (see open_csv) are read serially
+        :param has_headers: whether or not the CSV file has a header line; default is True
+        :param selected_columns: list of selected columns by either header name or index
+        :param workers: number of worker processes; default is the number of CPUs
+        :param chunk_size: approximate size in bytes of the chunk handed to each worker; default is 64 MiB
+        :param ordered: yield lines in file order if True, otherwise in whatever order chunks finish
+        :param encoding: text encoding of the file
+        :return: generator of lines as lists
+        """
+        if CSVUtils.is_compressed(infile):
+            # compressed streams can't be split at arbitrary offsets, so read them in a single pass
+            for line in CSVUtils.read_csv_iter(infile, has_headers, selected_columns, encoding=encoding):
+                yield line
+            return
+        with open(infile, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                start = 0
+                headers_map = None
+                if has_headers:
+                    start = CSVUtils._record_end(mm, 0)
+                    header = mm[:start].decode(encoding)
+                    headers_map = CSVUtils._read_headers(csv.reader(io.StringIO(header, newline='')))
+                boundaries = CSVUtils._chunk_boundaries(mm, start, chunk_size)
+            finally:
+                mm.close()
+        indexes = CSVUtils._resolve_columns(selected_columns, headers_map) if selected_columns else None
+        workers = workers or os.cpu_count() or 1
+        chunks = iter((infile, chunk_start, chunk_end, indexes, encoding)
+                      for chunk_start, chunk_end in zip(boundaries, boundaries[1:]))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # keep a bounded number of chunks in flight so results don't pile up in memory
+            pending = deque(executor.submit(_parse_csv_chunk, chunk) for chunk in islice(chunks, workers * 2))
+            while pending:
+                if ordered:
+                    done = [pending.popleft()]
+                else:
+                    done = wait(pending, return_when=FIRST_COMPLETED)[0]
+                    for future in done:
+                        pending.remove(future)
+                for future in done:
+                    for chunk in islice(chunks, 1):
+                        pending.append(executor.submit(_parse_csv_chunk, chunk))
+                    for line in future.result():
+                        yield line
+
+    @staticmethod
+    def _record_end(mm, pos):
+        """
+        Find the end of the CSV record starting at pos, skipping newlines inside quoted fields.
+        :param mm: mmap object of the file
+        :param pos: offset of the start of a record
+        :return: offset just past the record's trailing newline, or the file size
+        """
+        in_quotes = False
+        while True:
+            newline = mm.find(b'\n', pos)
+            if newline == -1:
+                return len(mm)
+            # each quote toggles quoting, which also holds for escaped ("") quotes
+            in_quotes ^= mm[pos:newline].count(b'"') & 1 == 1
+            pos = newline + 1
+            if not in_quotes:
+                return pos
+
+    @staticmethod
+    def _chunk_boundaries(mm, start, chunk_size):
+        """
+        Split a CSV file into chunks that only break between records.
+        :param mm: mmap object of the file
+        :param start: offset of the first data record
+        :param chunk_size: approximate size in bytes of each chunk
+        :return: list of chunk boundary offsets, from start to the file size
+        """
+        size = len(mm)
+        boundaries = [start]
+        pos = start
+        in_quotes = False
+        while pos < size:
+            target = pos + chunk_size
+            if target >= size:
+                boundaries.append(size)
+                break
+            # carry quote state from the last boundary up to the target, then finish the record there
+            in_quotes ^= mm[pos:target].count(b'"') & 1 == 1
+            while True:
+                newline = mm.find(b'\n', target)
+                if newline == -1:
+                    target = size
+                    break
+                in_quotes ^= mm[target:newline].count(b'"') & 1 == 1
+                target = newline + 1
+                if not in_quotes:
+                    break
+            boundaries.append(target)
+            pos = target
+        return boundaries
+
+    @staticmethod
+    def _resolve_columns(selected_columns, headers_map=None):
+        """
+        Resolve selected columns to column indexes.
+        :param selected_columns: list of selected columns by either header name or index
+        :param headers_map: dictionary where k = header name, v = column index; required when selecting by name
+        :return: list of column indexes
+        """
+        indexes = []
+        for c in selected_columns:
+            if isinstance(c, str):
+                if headers_map is None:
+                    raise ValueError('Selecting column %s by name requires a header line!' % c)
+                indexes.append(headers_map[c])
+            else:
+                indexes.append(c)
+        return indexes
+
+    @staticmethod
+    def _read_headers(csvreader):
+        """
+        Consume the header line from a CSV reader.
+        :param csvreader: csv.reader object positioned at the start of the file
+        :return: dictionary where k = header name, v = column index
+        """
+        for line in csvreader:
+            return dict((line[i], i) for i in range(len(line)))
+        return {}
+
+    @staticmethod
+    def _iter_rows(csvreader, headers_map, selected_columns, as_tuples=False):
+        """
+        Yield the non-empty lines of a CSV reader, projected onto the selected columns.
+        :param csvreader: csv.reader object positioned after any header line
+        :param headers_map: dictionary where k = header name, v = column index
+        :param selected_columns: list of selected columns by either header name or index
+        :param as_tuples: yield tuples instead of lists
+        :return: generator of lines
+        """
+        if selected_columns:
+            indexes = CSVUtils._resolve_columns(selected_columns, headers_map)
+            if len(indexes) == 1:
+                index = indexes[0]
+                project = (lambda line: (line[index],)) if as_tuples else (lambda line: [line[index]])
+            elif as_tuples:
+                project = itemgetter(*indexes)
+            else:
+                project = lambda line: [line[i] for i in indexes]
             for line in csvreader:
-                if l1:
-                    # skip reading header line
-                    l1 = False
-                    continue
                 # make sure this line has contents
-                if len(line):
-                    # pull only selected columns
-                    if selected_columns:
-                        selected_fields = []
-                        for c in selected_columns:
-                            if isinstance(selected_columns[0], str):
-                                # pull selected columns by header
-                                selected_fields.append(line[headers_map[c]])
-                            else:
-                                # pull selected columns by index
-                                selected_fields.append(line[c])
-                        if len(selected_fields):
-                            lines.append(selected_fields)
-                    else:
-                        if len(line):
-                            lines.append(line)
-        return lines, headers_map
+                if line:
+                    yield project(line)
+        elif as_tuples:
+            for line in csvreader:
+                if line:
+                    yield tuple(line)
+        else:
+            for line in csvreader:
+                if line:
+                    yield line
+
+
+def _parse_csv_chunk(chunk):
+    """
+    Parse one chunk of a CSV file; runs in a worker process for CSVUtils.read_csv_parallel.
+    :param chunk: tuple -- CSV file, chunk start offset, chunk end offset, selected column indexes, encoding
+    :return: list of non-empty lines as lists
+    """
+    infile, start, end, indexes, encoding = chunk
+    with open(infile, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            text = mm[start:end].decode(encoding)
+        finally:
+            mm.close()
+    csvreader = csv.reader(io.StringIO(text, newline=''))
+    return list(CSVUtils._iter_rows(csvreader, None, indexes))
+
+
+class _ParallelBlockWriter(object):
+    """Write-only file object that compresses fixed size blocks in a thread pool and writes them out in order."""
+
+    def __init__(self, fileobj, compress, workers, block_size):
+        """
+        Initialize class.
+        :param fileobj: binary file object to write compressed blocks to
+        :param compress: function compressing a block of bytes into a standalone compressed stream
+        :param workers: number of compression threads
+        :param block_size: size in bytes of each uncompressed block
+        """
+        self.fileobj = fileobj
+        self.compress = compress
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # bound the blocks held in memory to a couple per worker
+        self.max_pending = workers * 2
+        self.pending = deque()
+        self.buffer = bytearray()
+        self.closed = False
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def _submit(self, block):
+        self.pending.append(self.executor.submit(self.compress, block))
+        while len(self.pending) > self.max_pending:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+        finally:
+            self.executor.shutdown()
+
+
+class _DecompressingReader(io.RawIOBase):
+    """
+    Read-only raw stream decompressing a file that may hold several concatenated gzip members or bz2/xz streams,
+    reporting where each compressed member starts so it can be used later as a seek point.
+    """
+
+    """Map of compression options to a factory for a decompressor of one member or stream."""
+    decompressors = {
+        'gz': lambda: zlib.decompressobj(31),
+        'bz2': bz2.BZ2Decompressor,
+        'xz': lambda: lzma.LZMADecompressor(lzma.FORMAT_XZ),
+    }
+
+    def __init__(self, fileobj, compression, compressed_offset=0, position=0, on_member=None,
+                 read_size=64 * 1024):
+        """
+        Initialize class.
+        :param fileobj: binary file object of the archive
+        :param compression: gz, bz2, xz, or None for an uncompressed file
+        :param compressed_offset: offset in the file to start reading from; must be the start of a member
+        :param position: uncompressed offset corresponding to compressed_offset
+        :param on_member: optional function called with (compressed offset, uncompressed offset) for each member
+        :param read_size: number of compressed bytes read from the file at a time
+        """
+        io.RawIOBase.__init__(self)
+        self.fileobj = fileobj
+        self.fileobj.seek(compressed_offset)
+        self.new_decompressor = self.decompressors.get(compression)
+        self.decompressor = None
+        self.input_offset = compressed_offset
+        self.input = b''
+        self.output = bytearray()
+        self.position = position
+        self.produced = position
+        self.on_member = on_member
+        self.read_size = read_size
+        self.at_eof = False
+
+    def readable(self):
+        return True
+
+    def _read_input(self):
+        data = self.fileobj.read(self.read_size)
+        self.input_offset += len(data)
+        return data
+
+    def _fill(self):
+        if self.new_decompressor is None:
+            data = self._read_input()
+            if not data:
+                self.at_eof = True
+            self.output += data
+            self.produced += len(data)
+            return
+        if self.decompressor is None:
+            # skip NUL padding between members, then start the next member
+            while True:
+                if not self.input:
+                    self.input = self._read_input()
+                    if not self.input:
+                        self.at_eof = True
+                        return
+                self.input = self.input.lstrip(b'\x00')
+                if self.input:
+                    break
+            if self.on_member is not None:
+                self.on_member(self.input_offset - len(self.input), self.produced)
+            self.decompressor = self.new_decompressor()
+        data = self.input or self._read_input()
+        self.input = b''
+        if not data:
+            raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+        out = self.decompressor.decompress(data)
+        if self.decompressor.eof:
+            self.input = self.decompressor.unused_data
+            self.decompressor = None
+        self.output += out
+        self.produced += len(out)
+
+    def readinto(self, b):
+        while not self.output and not self.at_eof:
+            self._fill()
+        count = min(len(b), len(self.output))
+        b[:count] = self.output[:count]
+        del self.output[:count]
+        self.position += count
+        return count
+
+    def skip(self, count):
+        """
+        Discard decompressed bytes.
+        :param count: number of bytes to skip
+        :return: None
+        """
+        while count > 0:
+            while not self.output and not self.at_eof:
+                self._fill()
+            if not self.output:
+                raise EOFError('Archive ended while skipping to a member')
+            step = min(count, len(self.output))
+            del self.output[:step]
+            self.position += step
+            count -= step
+
+
+class _LimitedReader(io.RawIOBase):
+    """Read-only raw stream returning at most a fixed number of bytes from another stream."""
+
+    def __init__(self, raw, size, on_close=None):
+        io.RawIOBase.__init__(self)
+        self.raw = raw
+        self.remaining = size
+        self.on_close = on_close
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self.remaining <= 0:
+            return 0
+        view = memoryview(b)[:min(len(b), self.remaining)]
+        count = self.raw.readinto(view)
+        self.remaining -= count
+        return count
+
+    def close(self):
+        if not self.closed and self.on_close is not None:
+            self.on_close()
+        io.RawIOBase.close(self)
+
+
+class ArchiveIndex(object):
+    """
+    Random-access index of the members in a tar or zip file. For tar files the index is saved to a sidecar file and
+    includes seek points at every gzip member or bz2/xz stream, so members can be read without decompressing from
+    the start of the archive. Archives written by ArchiveUtils.create_tar with workers set have one seek point per
+    block; a single-stream compressed tar has one seek point, so reads still stop as soon as the member is done.
+    """
+
+    """Map of tarfile member types to the type names stored in the index."""
+    member_types = {tarfile.REGTYPE: 'file', tarfile.AREGTYPE: 'file', tarfile.CONTTYPE: 'file',
+                    tarfile.DIRTYPE: 'dir', tarfile.SYMTYPE: 'symlink', tarfile.LNKTYPE: 'link'}
+
+    def __init__(self, archive, index_data):
+        """
+        Initialize class; use ArchiveIndex.load or ArchiveIndex.build instead of calling this directly.
+        :param archive: path to the archive
+        :param index_data: dictionary of index contents
+        """
+        self.archive = archive
+        self.index_data = index_data
+        self.compression = index_data.get('compression')
+        self.seek_points = index_data.get('seek_points', [[0, 0]])
+        self.seek_positions = [position for _, position in self.seek_points]
+        self.member_map = dict((member['name'], member) for member in index_data['members'])
+
+    @staticmethod
+    def index_path(archive):
+        """
+        Get the default sidecar index path for an archive.
+        :param archive: path to the archive
+        :return: path to the index file
+        """
+        return '%s.idx' % archive
+
+    @staticmethod
+    def detect_compression(archive):
+        """
+        Detect the compression of a tar file from its magic bytes.
+        :param archive: path to the archive
+        :return: gz, bz2, xz, or None
+        """
+        with open(archive, 'rb') as f:
+            magic = f.read(6)
+        if magic.startswith(b'\x1f\x8b'):
+            return 'gz'
+        if magic.startswith(b'BZh'):
+            return 'bz2'
+        if magic.startswith(b'\xfd7zXZ\x00'):
+            return 'xz'
+        return None
+
+    @classmethod
+    def load(cls, archive, index_file=None):
+        """
+        Load the index of an archive, building (and saving) it first if it is missing or out of date.
+        :param archive: path to a tar or zip file
+        :param index_file: path to the sidecar index; default is the archive path plus .idx
+        :return: ArchiveIndex object
+        """
+        if is_zipfile(archive):
+            return cls.build(archive, index_file)
+        index_file = index_file or cls.index_path(archive)
+        stat = os.stat(archive)
+        if os.path.isfile(index_file):
+            with open(index_file) as f:
+                index_data = json.load(f)
+            if index_data.get('size') == stat.st_size and index_data.get('mtime') == stat.st_mtime:
+                return cls(archive, index_data)
+        return cls.build(archive, index_file)
+
+    @classmethod
+    def build(cls, archive, index_file=None):
+        """
+        Scan an archive once and record every member's offset; for tar files the index is written to a sidecar file.
+        :param archive: path to a tar or zip file
+        :param index_file: path to the sidecar index; default is the archive path plus .idx
+        :return: ArchiveIndex object
+        """
+        stat = os.stat(archive)
+        if is_zipfile(archive):
+            # the zip central directory already is a random-access index
+            with ZipFile(archive, 'r') as zip:
+                members = [{'name': info.filename, 'type': 'dir' if info.is_dir() else 'file',
+                            'size': info.file_size} for info in zip.infolist()]
+            return cls(archive, {'format': 'zip', 'size': stat.st_size, 'mtime': stat.st_mtime, 'members': members})
+        compression = cls.detect_compression(archive)
+        seek_points = []
+        members = []
+        with open(archive, 'rb') as f:
+            reader = _DecompressingReader(f, compression,
+                                          on_member=lambda offset, position: seek_points.append([offset, position]))
+            with tarfile.open(fileobj=io.BufferedReader(reader, 1024 * 1024), mode='r|') as tar:
+                for tarinfo in tar:
+                    members.append({'name': tarinfo.name, 'type': cls.member_types.get(tarinfo.type, 'other'),
+                                    'offset': tarinfo.offset_data, 'size': tarinfo.size, 'mode': tarinfo.mode,
+                                    'mtime': tarinfo.mtime, 'linkname': tarinfo.linkname})
+        index_data = {'format': 'tar', 'compression': compression, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                      'seek_points': seek_points or [[0, 0]], 'members': members}
+        with open(index_file or cls.index_path(archive), 'w') as f:
+            json.dump(index_data, f)
+        return cls(archive, index_data)
+
+    def members(self, patterns=None):
+        """
+        List the members of the archive.
+        :param patterns: optional glob pattern or list of patterns (i.e. logs/*.csv) to filter member names
+        :return: list of member names in archive order
+        """
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        return [member['name'] for member in self.index_data['members']
+                if patterns is None or any(fnmatchcase(member['name'], p) for p in patterns)]
+
+    def open(self, name):
+        """
+        Open one member of the archive for streaming, starting from the nearest seek point.
+        :param name: member name
+        :return: readable binary file object
+        """
+        if self.index_data['format'] == 'zip':
+            zip = ZipFile(self.archive, 'r')
+            try:
+                return zip.open(name)
+            finally:
+                # the member keeps the underlying file open until it is closed itself
+                zip.close()
+        member = self.member_map[name]
+        f = open(self.archive, 'rb')
+        reader = self._reader_at(f, member['offset'])
+        return io.BufferedReader(_LimitedReader(reader, member['size'], on_close=f.close))
+
+    def read(self, name):
+        """
+        Read one member of the archive into memory.
+        :param name: member name
+        :return: bytes of the member
+        """
+        with self.open(name) as f:
+            return f.read()
+
+    def extract(self, output_dir, patterns=None):
+        """
+        Extract only the members matching the given patterns, skipping over everything else.
+        :param output_dir: directory to extract files to
+        :param patterns: optional glob pattern or list of patterns to select members; default is all members
+        :return: list of paths written
+        """
+        root = os.path.realpath(output_dir)
+        written = []
+        selected = [self.member_map.get(name, {'name': name, 'type': 'file'}) for name in self.members(patterns)]
+        if self.index_data['format'] == 'zip':
+            with ZipFile(self.archive, 'r') as zip:
+                for member in selected:
+                    written.append(zip.extract(member['name'], path=output_dir))
+            return written
+        # walk selected members in archive order, reusing one forward reader unless a closer seek point exists
+        selected.sort(key=lambda m: m.get('offset', 0))
+        with open(self.archive, 'rb') as f:
+            reader = None
+            for member in selected:
+                target = os.path.realpath(os.path.join(root, member['name']))
+                if not target.startswith(root + os.sep):
+                    print("[*] Warning, not extracting member %s outside of %s..." % (member['name'], output_dir))
+                    continue
+                if member['type'] == 'dir':
+                    if not os.path.isdir(target):
+                        os.makedirs(target)
+                    continue
+                if member['type'] != 'file':
+                    print("[*] Warning, not extracting %s member %s..." % (member['type'], member['name']))
+                    continue
+                offset = member['offset']
+                point = bisect_right(self.seek_positions, offset) - 1
+                if reader is None or self.compression is None or reader.position > offset or \
+                        self.seek_positions[point] > reader.position:
+                    reader = self._reader_at(f, offset)
+                else:
+                    reader.skip(offset - reader.position)
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                remaining = member['size']
+                with open(target, 'wb') as out:
+                    while remaining > 0:
+                        chunk = reader.read(min(remaining, 1024 * 1024))
+                        if not chunk:
+                            raise EOFError('Archive ended in the middle of member %s' % member['name'])
+                        out.write(chunk)
+                        remaining -= len(chunk)
+                os.chmod(target, member['mode'] & 0o777)
+                os.utime(target, (member['mtime'], member['mtime']))
+                written.append(target)
+        return written
+
+    def _reader_at(self, f, offset):
+        """
+        Build a reader positioned at an uncompressed offset, starting from the closest seek point before it.
+        :param f: binary file object of the archive
+        :param offset: uncompressed offset to position the reader at
+        :return: _DecompressingReader object
+        """
+        if self.compression is None:
+            # uncompressed offsets are file offsets
+            return _DecompressingReader(f, None, offset, offset)
+        compressed_offset, position = self.seek_points[bisect_right(self.seek_positions, offset) - 1]
+        reader = _DecompressingReader(f, self.compression, compressed_offset, position)
+        reader.skip(offset - position)
+        return reader
 
 
 class ArchiveUtils:
     """This class simplifies the process of working with archive type files (i.e. tar, zip)."""
 
+    """Map of tar compression options to functions compressing one block into a complete, standalone stream."""
+    block_compressors = {'gz': gzip.compress, 'bz2': bz2.compress, 'xz': lzma.compress}
+
+    """Name of the member holding the file list of an incremental archive; it is always the first member."""
+    incremental_manifest = '.manifest.json'
+
     def __init__(self):
         pass
 
     @staticmethod
-    def create_tar(sources, output_file, compression=None):
+    def create_tar(sources, output_file, compression=None, workers=None, block_size=4 * 1024 * 1024):
         """
         Write a set of files and/or directories to a tar file.
         :param sources: list of files and/or directories to add to the archive
         :param output_file: file to write archived contents to
         :param compression: options are None (which is the default), gz, bz2, or xz
+        :param workers: number of threads compressing blocks in parallel; None (the default) compresses on one core
+        :param block_size: size in bytes of the uncompressed blocks compressed in parallel; default is 4 MiB
         :return: None
         """
+        output_file, write_mode = ArchiveUtils._tar_name(output_file, compression)
+        if compression is None or workers is None:
+            with tarfile.open(output_file, write_mode) as tar:
+                ArchiveUtils._add_to_tar(tar, sources)
+            return
+        # each block becomes its own gzip member / bz2 or xz stream, which the standard tools read as one stream
+        with open(output_file, 'wb') as f:
+            writer = _ParallelBlockWriter(f, ArchiveUtils.block_compressors[compression], workers, block_size)
+            try:
+                with tarfile.open(fileobj=writer, mode='w|') as tar:
+                    ArchiveUtils._add_to_tar(tar, sources)
+            finally:
+                writer.close()
+
+    @staticmethod
+    def _add_to_tar(tar, sources):
+        """
+        Add a set of files and/or directories to an open tar file.
+        :param tar: TarFile object opened for writing
+        :param sources: list of files and/or directories to add to the archive
+        :return: None
+        """
+        for source in sources:
+            if os.path.isdir(source):
+                tar.add(source, arcname=os.path.basename(source))
+            elif os.path.isfile(source):
+                tar.add(source)
+            else:
+                print("[*] Warning, not adding nonexistent object %s to archive..." % source)
+
+    @staticmethod
+    def _tar_name(output_file, compression):
+        """
+        Add the tar and compression extensions to a filename if necessary.
+        :param output_file: file to write archived contents to
+        :param compression: None, gz, bz2, or xz
+        :return: tuple -- output filename, tarfile write mode
+        """
         # add .tar extension to filename if necessary
         if not output_file.endswith('.tar'):
             output_file = '%s.tar' % output_file
@@ -92,25 +889,183 @@ class ArchiveUtils:
             # add compression extension to filename if necessary
             if not output_file.endswith('.%s' % compression):
                 output_file = '%s.%s' % (output_file, compression)
-        with tarfile.open(output_file, write_mode) as tar:
-            for source in sources:
-                if os.path.isdir(source):
-                    tar.add(source, arcname=os.path.basename(source))
-                elif os.path.isfile(source):
-                    tar.add(source)
-                else:
-                    print("[*] Warning, not adding nonexistent object %s to archive..." % source)
+        return output_file, write_mode
+
+    @staticmethod
+    def _walk_sources(sources):
+        """
+        List the files under a set of sources with the names create_tar would give them in the archive.
+        :param sources: list of files and/or directories
+        :return: generator of (path on disk, name in archive) tuples
+        """
+        for source in sources:
+            if os.path.isdir(source):
+                parent = os.path.dirname(os.path.normpath(source))
+                for root, dirs, files in os.walk(source):
+                    dirs.sort()
+                    for file in sorted(files):
+                        path = os.path.join(root, file)
+                        yield path, os.path.relpath(path, parent).replace(os.sep, '/')
+            elif os.path.isfile(source):
+                yield source, os.path.normpath(source).replace(os.sep, '/').lstrip('/')
+            else:
+                print("[*] Warning, not adding nonexistent object %s to archive..." % source)
 
     @staticmethod
-    def extract_tar(input_file, output_dir):
+    def _hash_file(path):
+        """
+        Calculate the SHA-256 digest of a file's contents.
+        :param path: file to hash
+        :return: hex digest
+        """
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    @staticmethod
+    def create_incremental(sources, output_file, manifest_file, compression=None, dedupe=False):
+        """
+        Write only the files that are new or changed since the last run to a delta tar file. The first run (with no
+        manifest yet) writes a full base archive.
+        :param sources: list of files and/or directories to add to the archive
+        :param output_file: file to write archived contents to
+        :param manifest_file: JSON file keeping the path, size, mtime and content hash of every file from the last run;
+            it is read before and rewritten after writing the archive
+        :param compression: options are None (which is the default), gz, bz2, or xz
+        :param dedupe: store each distinct content once, under .objects/<sha256>, skipping content already stored by
+            an earlier archive in the chain
+        :return: dictionary of stats -- archive, added, changed, unchanged, deleted, stored
+        """
+        previous = {'files': {}, 'objects': []}
+        if os.path.isfile(manifest_file):
+            with open(manifest_file) as f:
+                previous = json.load(f)
+        known_objects = set(previous.get('objects', []))
+        files = {}
+        changed = {}
+        stats = {'added': 0, 'changed': 0, 'unchanged': 0, 'deleted': 0, 'stored': 0}
+        for path, arcname in ArchiveUtils._walk_sources(sources):
+            st = os.stat(path)
+            entry = {'size': st.st_size, 'mtime': st.st_mtime, 'mode': st.st_mode & 0o777}
+            old = previous['files'].get(arcname)
+            # same size and mtime means unchanged, so the file isn't even read
+            if old is not None and old['size'] == entry['size'] and old['mtime'] == entry['mtime']:
+                entry['sha256'] = old['sha256']
+            else:
+                entry['sha256'] = ArchiveUtils._hash_file(path)
+            files[arcname] = entry
+            if old is not None and old['sha256'] == entry['sha256']:
+                stats['unchanged'] += 1
+                continue
+            stats['changed' if old is not None else 'added'] += 1
+            changed[arcname] = (path, entry)
+        deleted = sorted(set(previous['files']) - set(files))
+        stats['deleted'] = len(deleted)
+        # decide which member holds each changed file's content
+        members = {}
+        to_store = []
+        for arcname, (path, entry) in sorted(changed.items()):
+            if not dedupe:
+                member = arcname
+            else:
+                member = '.objects/%s' % entry['sha256']
+                if entry['sha256'] in known_objects:
+                    # stored by this or an earlier archive; restore finds it by hash
+                    member = None
+                known_objects.add(entry['sha256'])
+            if member is not None:
+                to_store.append((path, member))
+            members[arcname] = member
+        output_file, write_mode = ArchiveUtils._tar_name(output_file, compression)
+        manifest = json.dumps({'changed': dict((arcname, dict(entry, member=members[arcname]))
+                                               for arcname, (_, entry) in changed.items()),
+                               'deleted': deleted, 'dedupe': dedupe}).encode('utf-8')
+        # store what a symlinked source points to, since that is the content that was hashed
+        with tarfile.open(output_file, write_mode, dereference=True) as tar:
+            tarinfo = tarfile.TarInfo(ArchiveUtils.incremental_manifest)
+            tarinfo.size = len(manifest)
+            tarinfo.mtime = time.time()
+            tar.addfile(tarinfo, io.BytesIO(manifest))
+            for path, member in to_store:
+                tar.add(path, arcname=member)
+        stats['stored'] = len(to_store)
+        with open(manifest_file, 'w') as f:
+            json.dump({'files': files, 'objects': sorted(known_objects) if dedupe else []}, f)
+        stats['archive'] = output_file
+        return stats
+
+    @staticmethod
+    def restore_incremental(archives, output_dir):
+        """
+        Restore the latest state of the files from a base archive followed by its delta archives.
+        :param archives: list of archives written by create_incremental, base first, in the order they were written
+        :param output_dir: directory to extract files to
+        :return: list of paths written
+        """
+        # replay manifests to find the final state of every file and which archive member holds its content
+        state = {}
+        objects = {}
+        for archive in archives:
+            with tarfile.open(archive, 'r') as tar:
+                tarinfo = tar.next()
+                if tarinfo is None or tarinfo.name != ArchiveUtils.incremental_manifest:
+                    raise ValueError('%s is not an incremental archive' % archive)
+                manifest = json.loads(tar.extractfile(tarinfo).read().decode('utf-8'))
+            for arcname in manifest['deleted']:
+                state.pop(arcname, None)
+            for arcname, entry in manifest['changed'].items():
+                # any stored copy of the same content will do, so keep the first one seen
+                if entry['member'] is not None:
+                    objects.setdefault(entry['sha256'], (archive, entry['member']))
+                state[arcname] = entry
+        # group the surviving files by the archive member holding their content, then read each archive once
+        wanted = {}
+        for arcname, entry in state.items():
+            archive, member = objects[entry['sha256']]
+            wanted.setdefault(archive, {}).setdefault(member, []).append((arcname, entry))
+        root = os.path.realpath(output_dir)
+        written = []
+        for archive in archives:
+            if archive not in wanted:
+                continue
+            needed = wanted[archive]
+            with tarfile.open(archive, 'r') as tar:
+                for tarinfo in tar:
+                    if tarinfo.name not in needed:
+                        continue
+                    for arcname, entry in needed.pop(tarinfo.name):
+                        target = os.path.realpath(os.path.join(root, arcname))
+                        if not target.startswith(root + os.sep):
+                            print("[*] Warning, not extracting member %s outside of %s..." % (arcname, output_dir))
+                            continue
+                        if not os.path.isdir(os.path.dirname(target)):
+                            os.makedirs(os.path.dirname(target))
+                        with tar.extractfile(tarinfo) as src, open(target, 'wb') as dst:
+                            shutil.copyfileobj(src, dst, 1024 * 1024)
+                        os.chmod(target, entry['mode'])
+                        os.utime(target, (entry['mtime'], entry['mtime']))
+                        written.append(target)
+                    if not needed:
+                        break
+        return written
+
+    @staticmethod
+    def extract_tar(input_file, output_dir, patterns=None):
         """
         Extract the contents of a tar file to a directory.
         :param input_file: tar file to extract from
         :param output_dir: directory to extract files to
+        :param patterns: optional glob pattern or list of patterns; if given, only matching members are extracted,
+            using (and building on first use) a sidecar ArchiveIndex so the rest of the archive is skipped
         :return: True on success, False otherwise
         """
         if not tarfile.is_tarfile(input_file):
             return False
+        if patterns is not None:
+            ArchiveIndex.load(input_file).extract(output_dir, patterns)
+            return True
         with tarfile.open(input_file, 'r') as tar:
             tar.extractall(path=output_dir)
         return True
@@ -138,15 +1093,90 @@ class ArchiveUtils:
                     print("[*] Warning, not adding nonexistent object %s to archive..." % source)
 
     @staticmethod
-    def extract_zip(input_file, output_dir):
+    def extract_zip(input_file, output_dir, patterns=None, workers=None):
         """
         Extract the contents of a zip file to a directory.
         :param input_file: zip file to extract from
         :param output_dir: directory to extract files to
+        :param patterns: optional glob pattern or list of patterns; if given, only matching members are extracted
+        :param workers: number of threads inflating members in parallel; None (the default) extracts serially
         :return: True on success, False otherwise
         """
         if not is_zipfile(input_file):
             return False
+        if workers is not None:
+            ArchiveUtils.extract_zip_parallel(input_file, output_dir, workers, patterns)
+            return True
+        if patterns is not None:
+            ArchiveIndex.load(input_file).extract(output_dir, patterns)
+            return True
         with ZipFile(input_file, 'r') as zip:
             zip.extractall(path=output_dir)
         return True
+
+    @staticmethod
+    def extract_zip_parallel(input_file, output_dir, workers=None, patterns=None, verbose=False):
+        """
+        Extract the members of a zip file across a pool of threads, each with its own handle on the zip file.
+        :param input_file: zip file to extract from
+        :param output_dir: directory to extract files to
+        :param workers: number of threads; default is the number of CPUs
+        :param patterns: optional glob pattern or list of patterns to select members; default is all members
+        :param verbose: whether or not to print throughput for each member and for the whole extraction
+        :return: dictionary of stats -- members (list of (name, bytes, seconds) tuples), bytes, seconds, mb_per_sec
+        """
+        if isinstance(patterns, str):
+            patterns = [patterns]
+        root = os.path.realpath(output_dir)
+        with ZipFile(input_file, 'r') as zip:
+            infos = [info for info in zip.infolist()
+                     if patterns is None or any(fnmatchcase(info.filename, p) for p in patterns)]
+        # resolve every target up front so unsafe paths are refused and directories exist before workers start
+        jobs = []
+        for info in infos:
+            target = os.path.realpath(os.path.join(root, info.filename))
+            if not target.startswith(root + os.sep):
+                print("[*] Warning, not extracting member %s outside of %s..." % (info.filename, output_dir))
+                continue
+            if info.is_dir():
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                continue
+            if not os.path.isdir(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+            jobs.append((info, target))
+        # start the largest members first so one big member doesn't finish last on its own
+        jobs.sort(key=lambda job: job[0].compress_size, reverse=True)
+        handles = threading.local()
+        opened = []
+        lock = threading.Lock()
+
+        def extract_member(job):
+            info, target = job
+            if getattr(handles, 'zip', None) is None:
+                handles.zip = ZipFile(input_file, 'r')
+                with lock:
+                    opened.append(handles.zip)
+            start = time.time()
+            with handles.zip.open(info) as src, open(target, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+            return info.filename, info.file_size, time.time() - start
+
+        start = time.time()
+        try:
+            with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+                members = list(executor.map(extract_member, jobs))
+        finally:
+            for zip in opened:
+                zip.close()
+        seconds = time.time() - start
+        total = sum(size for _, size, _ in members)
+        stats = {'members': members, 'bytes': total, 'seconds': seconds,
+                 'mb_per_sec': total / seconds / 1e6 if seconds else 0.0}
+        if verbose:
+            for name, size, member_seconds in members:
+                print("[*] Extracted %s: %d bytes in %.3fs (%.1f MB/s)" % (
+                    name, size, member_seconds, size / member_seconds / 1e6 if member_seconds else 0.0))
+            print("[*] Extracted %d members: %d bytes in %.3fs (%.1f MB/s)" % (
+                len(members), total, seconds, stats['mb_per_sec']))
+        return stats
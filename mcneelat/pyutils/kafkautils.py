@@ -1,7 +1,241 @@
+import atexit
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 import json
-from kafka import KafkaConsumer, KafkaProducer
+from kafka import codec, ConsumerRebalanceListener, KafkaConsumer, KafkaProducer
+from kafka.structs import OffsetAndMetadata
 from mcneelat.pyutils.confutils import AbstractLogUtils
+import os
 from random import randint
+import threading
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+
+def json_serializer(value):
+    """
+    Serialize a value to compact UTF-8 JSON, using orjson when it is installed.
+    :param value: JSON serializable object
+    :return: bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(value)
+    return _json_encoder.encode(value).encode('utf-8')
+
+
+def json_deserializer(data):
+    """
+    Deserialize UTF-8 JSON, using orjson when it is installed.
+    :param data: bytes
+    :return: deserialized object
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data.decode('utf-8'))
+
+
+def _offset_and_metadata(offset):
+    """
+    Build an offset to commit; kafka-python 1.x takes (offset, metadata) and 2.x added leader_epoch.
+    :param offset: offset of the next message to consume
+    :return: OffsetAndMetadata object
+    """
+    if 'leader_epoch' in OffsetAndMetadata._fields:
+        return OffsetAndMetadata(offset, '', -1)
+    return OffsetAndMetadata(offset, '')
+
+
+def _process_batch(handler, deserializer, values):
+    """
+    Deserialize a batch of message values and pass it to a handler; runs in a worker thread or process.
+    :param handler: function taking a list of values
+    :param deserializer: function turning bytes into a value, or None to pass the raw bytes
+    :param values: list of raw message values
+    :return: number of messages processed
+    """
+    if deserializer is not None:
+        values = [None if value is None else deserializer(value) for value in values]
+    handler(values)
+    return len(values)
+
+
+def best_compression():
+    """
+    Pick the cheapest compression codec available to kafka-python, falling back to gzip which is always available.
+    :return: compression type name
+    """
+    if codec.has_lz4():
+        return 'lz4'
+    if codec.has_snappy():
+        return 'snappy'
+    return 'gzip'
+
+
+class BatchingProducer(AbstractLogUtils):
+    """Asynchronous Kafka producer tuned for throughput, with bounded in-flight messages and delivery counters."""
+
+    def __init__(self, bootstrap_servers, topic, client_id=None, linger_ms=20, batch_size=256 * 1024,
+                 compression_type='auto', acks=1, max_in_flight=10000, value_serializer=json_serializer, verbose=True,
+                 **producer_config):
+        """
+        Initialize class.
+        :param bootstrap_servers: list of bootstrap servers to connect to
+        :param topic: default topic to write to
+        :param client_id: client ID reported to the brokers
+        :param linger_ms: milliseconds to wait for more messages before sending a partly filled batch
+        :param batch_size: maximum size in bytes of a batch of messages sent to one partition
+        :param compression_type: 'gzip', 'snappy', 'lz4', None for no compression, or 'auto' (which is the default)
+            to pick the best available codec
+        :param acks: number of broker acknowledgments required (0, 1 or 'all')
+        :param max_in_flight: maximum number of messages sent but not yet acknowledged; send blocks at the limit
+        :param value_serializer: function turning a value into bytes; default is compact UTF-8 JSON
+        :param verbose: whether or not to print log messages
+        :param producer_config: any other KafkaProducer configuration
+        """
+        AbstractLogUtils.__init__(self, verbose)
+        self.topic = topic
+        self.compression_type = best_compression() if compression_type == 'auto' else compression_type
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+        self.counters = {'sent': 0, 'acked': 0, 'failed': 0, 'bytes': 0}
+        self.started = time.time()
+        self.closed = False
+        self.producer = KafkaProducer(bootstrap_servers=bootstrap_servers, client_id=client_id, linger_ms=linger_ms,
+                                      batch_size=batch_size, compression_type=self.compression_type, acks=acks,
+                                      value_serializer=value_serializer, key_serializer=self._serialize_key,
+                                      **producer_config)
+        # make sure buffered messages are delivered even if close is never called
+        atexit.register(self.close)
+
+    @staticmethod
+    def _serialize_key(key):
+        """
+        Serialize a message key, encoding strings as UTF-8.
+        :param key: string, bytes or None
+        :return: bytes or None
+        """
+        if isinstance(key, str):
+            return key.encode('utf-8')
+        return key
+
+    def send(self, value, key=None, topic=None, partition=None, on_success=None, on_error=None):
+        """
+        Queue a message for delivery without waiting for it, blocking only while max_in_flight messages are pending.
+        :param value: message value, passed to the value serializer
+        :param key: optional message key
+        :param topic: topic to write to; default is the producer's topic
+        :param partition: optional partition to write to
+        :param on_success: optional function called with the RecordMetadata once the message is acknowledged
+        :param on_error: optional function called with the exception if delivery fails
+        :return: kafka FutureRecordMetadata object
+        """
+        self.in_flight.acquire()
+        try:
+            future = self.producer.send(topic or self.topic, value=value, key=key, partition=partition)
+        except Exception:
+            self.in_flight.release()
+            # count it as sent too, so pending (sent - acked - failed) stays right
+            with self.lock:
+                self.counters['sent'] += 1
+                self.counters['failed'] += 1
+            raise
+        with self.lock:
+            self.counters['sent'] += 1
+        future.add_callback(self._delivered, on_success)
+        future.add_errback(self._failed, on_error)
+        return future
+
+    def send_many(self, values, topic=None):
+        """
+        Queue many messages for delivery.
+        :param values: iterable of message values, or of (key, value) tuples
+        :param topic: topic to write to; default is the producer's topic
+        :return: number of messages queued
+        """
+        sent = 0
+        for value in values:
+            if isinstance(value, tuple):
+                self.send(value[1], key=value[0], topic=topic)
+            else:
+                self.send(value, topic=topic)
+            sent += 1
+        return sent
+
+    def _delivered(self, on_success, metadata):
+        """
+        Delivery callback: release the in-flight slot and count the message.
+        :param on_success: user callback or None
+        :param metadata: RecordMetadata object
+        :return: None
+        """
+        self.in_flight.release()
+        with self.lock:
+            self.counters['acked'] += 1
+            self.counters['bytes'] += max(metadata.serialized_value_size, 0) + max(metadata.serialized_key_size, 0)
+        if on_success is not None:
+            on_success(metadata)
+
+    def _failed(self, on_error, exception):
+        """
+        Error callback: release the in-flight slot and count the failure.
+        :param on_error: user callback or None
+        :param exception: delivery exception
+        :return: None
+        """
+        self.in_flight.release()
+        with self.lock:
+            self.counters['failed'] += 1
+        if on_error is not None:
+            on_error(exception)
+        else:
+            print("[*] Warning: failed to deliver Kafka message: %s" % exception)
+
+    def flush(self, timeout=None):
+        """
+        Block until every queued message has been delivered or has failed.
+        :param timeout: optional maximum number of seconds to wait
+        :return: None
+        """
+        self.producer.flush(timeout)
+
+    def stats(self):
+        """
+        Get throughput statistics.
+        :return: dictionary of sent, acked, failed, bytes, pending, elapsed seconds, messages_per_second and
+            bytes_per_second (based on acknowledged messages)
+        """
+        with self.lock:
+            stats = dict(self.counters)
+        stats['pending'] = stats['sent'] - stats['acked'] - stats['failed']
+        stats['elapsed'] = time.time() - self.started
+        stats['messages_per_second'] = stats['acked'] / stats['elapsed'] if stats['elapsed'] else 0.0
+        stats['bytes_per_second'] = stats['bytes'] / stats['elapsed'] if stats['elapsed'] else 0.0
+        return stats
+
+    def close(self, timeout=None):
+        """
+        Flush queued messages and close the producer.
+        :param timeout: optional maximum number of seconds to wait for delivery
+        :return: None
+        """
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister(self.close)
+        self.log("[*] Flushing and closing Kafka producer...")
+        self.producer.flush(timeout)
+        self.producer.close(timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
 
 class KafkaBuilder(AbstractLogUtils):
@@ -26,11 +260,25 @@ class KafkaBuilder(AbstractLogUtils):
         self.log("[*] Initializing Kafka consumer with consumer ID: %s" % consumer_id)
         if is_json:
             consumer = KafkaConsumer(topic, bootstrap_servers=self.bootstrap_servers, client_id=consumer_id,
-                                     value_deserializer=lambda m: json.loads(m.decode('ascii')))
+                                     value_deserializer=json_deserializer)
         else:
             consumer = KafkaConsumer(topic, bootstrap_servers=self.bootstrap_servers, client_id=consumer_id)
         return consumer
 
+    def get_batch_consumer(self, topics, group_id, handler, **kwargs):
+        """
+        Build a consumer group member that processes batches of messages in a worker pool (see BatchConsumer).
+        :param topics: topic name or list of topic names to consume
+        :param group_id: consumer group to join
+        :param handler: function called with each list of deserialized values
+        :param kwargs: BatchConsumer options (i.e. max_records, workers, use_processes, value_deserializer)
+        :return: BatchConsumer object
+        """
+        consumer_id = "%d-%s-%d" % (randint(0, 16777216), group_id, randint(0, 16777216))
+        self.log("[*] Initializing Kafka batch consumer in group %s with consumer ID: %s" % (group_id, consumer_id))
+        kwargs.setdefault('verbose', self.verbose)
+        return BatchConsumer(self.bootstrap_servers, topics, group_id, handler, client_id=consumer_id, **kwargs)
+
     def get_producer(self, topic):
         """
         Build a Kafka producer object.
@@ -41,3 +289,168 @@ class KafkaBuilder(AbstractLogUtils):
         self.log("[*] Initializing Kafka producer with producer ID: %s" % producer_id)
         producer = KafkaProducer(bootstrap_servers=self.bootstrap_servers, client_id=producer_id)
         return producer
+
+    def get_batching_producer(self, topic, **kwargs):
+        """
+        Build a high-throughput asynchronous producer that batches, compresses and serializes messages to JSON.
+        :param topic: default topic to write to
+        :param kwargs: BatchingProducer options (i.e. linger_ms, batch_size, compression_type, max_in_flight)
+        :return: BatchingProducer object
+        """
+        producer_id = "%d-%s-%d" % (randint(0, 16777216), topic, randint(0, 16777216))
+        self.log("[*] Initializing batching Kafka producer with producer ID: %s" % producer_id)
+        kwargs.setdefault('verbose', self.verbose)
+        return BatchingProducer(self.bootstrap_servers, topic, client_id=producer_id, **kwargs)
+
+
+class _RevokeListener(ConsumerRebalanceListener):
+    """Rebalance listener that lets a BatchConsumer finish and commit its work before partitions move."""
+
+    def __init__(self, runner):
+        self.runner = runner
+
+    def on_partitions_revoked(self, revoked):
+        self.runner.drain(revoked)
+
+    def on_partitions_assigned(self, assigned):
+        self.runner.log("[*] Assigned partitions: %s" % ', '.join('%s-%d' % (tp.topic, tp.partition)
+                                                                   for tp in assigned))
+
+
+class BatchConsumer(AbstractLogUtils):
+    """Consumer group member that processes polled batches in a worker pool and commits only finished offsets."""
+
+    def __init__(self, bootstrap_servers, topics, group_id, handler, client_id=None, max_records=500, workers=None,
+                 use_processes=False, value_deserializer=json_deserializer, poll_timeout_ms=1000, max_pending=None,
+                 verbose=True, **consumer_config):
+        """
+        Initialize class.
+        :param bootstrap_servers: list of bootstrap servers to connect to
+        :param topics: topic name or list of topic names to consume
+        :param group_id: consumer group to join; partitions are shared among all members of the group
+        :param handler: function called with a list of deserialized values from one partition; it must be a
+            module-level function when use_processes is True
+        :param client_id: client ID reported to the brokers
+        :param max_records: maximum number of messages returned by each poll
+        :param workers: number of worker threads or processes; default is the executor's default
+        :param use_processes: whether or not to process batches in a process pool instead of a thread pool
+        :param value_deserializer: function turning message bytes into a value (default is UTF-8 JSON), or None to
+            pass the raw bytes; it runs in the workers
+        :param poll_timeout_ms: milliseconds each poll waits for messages
+        :param max_pending: maximum number of batches queued or running before polling pauses; default is twice the
+            number of workers
+        :param verbose: whether or not to print log messages
+        :param consumer_config: any other KafkaConsumer configuration (i.e. auto_offset_reset)
+        """
+        AbstractLogUtils.__init__(self, verbose)
+        self.handler = handler
+        self.max_records = max_records
+        self.value_deserializer = value_deserializer
+        self.poll_timeout_ms = poll_timeout_ms
+        executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        self.executor = executor_class(workers)
+        self.max_pending = max_pending or 2 * (workers or os.cpu_count() or 1)
+        # per partition, the batches submitted in offset order as (next_offset, future)
+        self.pending = {}
+        self.counters = {'records': 0, 'batches': 0, 'commits': 0}
+        self.started = None
+        self.stopping = False
+        self.error = None
+        if isinstance(topics, str):
+            topics = [topics]
+        self.consumer = KafkaConsumer(bootstrap_servers=bootstrap_servers, group_id=group_id, client_id=client_id,
+                                      enable_auto_commit=False, max_poll_records=max_records, **consumer_config)
+        self.consumer.subscribe(topics, listener=_RevokeListener(self))
+
+    def run(self, max_batches=None):
+        """
+        Poll and process messages until stop is called (i.e. from a handler or signal handler) or max_batches
+        batches have been submitted, then finish outstanding batches, commit and close the consumer.
+        :param max_batches: optional number of batches after which to stop
+        :return: dictionary of statistics (see stats)
+        """
+        self.started = time.time()
+        submitted = 0
+        try:
+            while not self.stopping and (max_batches is None or submitted < max_batches):
+                self._wait_pending(self.max_pending)
+                records = self.consumer.poll(self.poll_timeout_ms, self.max_records)
+                for tp, messages in records.items():
+                    future = self.executor.submit(_process_batch, self.handler, self.value_deserializer,
+                                                  [message.value for message in messages])
+                    self.pending.setdefault(tp, []).append((messages[-1].offset + 1, future))
+                    submitted += 1
+                self.commit()
+            self.drain()
+        finally:
+            self.consumer.close(autocommit=False)
+            self.executor.shutdown()
+        if self.error is not None:
+            raise self.error
+        return self.stats()
+
+    def stop(self):
+        """
+        Ask run to stop after the current poll.
+        :return: None
+        """
+        self.stopping = True
+
+    def _wait_pending(self, limit):
+        """
+        Block until fewer than limit batches are outstanding, committing whatever finished.
+        :param limit: maximum number of outstanding batches
+        :return: None
+        """
+        futures = [future for batches in self.pending.values() for _, future in batches]
+        while len(futures) >= limit:
+            done, not_done = wait(futures, return_when=FIRST_COMPLETED)
+            self.commit()
+            futures = list(not_done)
+
+    def commit(self):
+        """
+        Commit, per partition, the offset after the last batch of the contiguous run of finished batches. A batch
+        that failed is never committed past; it stops the runner and run raises its exception.
+        :return: None
+        """
+        offsets = {}
+        for tp, batches in self.pending.items():
+            while batches and batches[0][1].done():
+                next_offset, future = batches[0]
+                if future.exception() is not None:
+                    # the failed batch stays queued so nothing after it in the partition gets committed
+                    self.error = self.error or future.exception()
+                    self.stopping = True
+                    break
+                batches.pop(0)
+                offsets[tp] = _offset_and_metadata(next_offset)
+                self.counters['records'] += future.result()
+                self.counters['batches'] += 1
+        if offsets:
+            self.consumer.commit(offsets)
+            self.counters['commits'] += 1
+
+    def drain(self, partitions=None):
+        """
+        Wait for the outstanding batches of some or all partitions and commit them.
+        :param partitions: optional list of TopicPartition objects; default is all partitions
+        :return: None
+        """
+        futures = [future for tp, batches in self.pending.items() if partitions is None or tp in partitions
+                   for _, future in batches]
+        wait(futures)
+        self.commit()
+        for tp in list(self.pending):
+            if not self.pending[tp] and (partitions is None or tp in partitions):
+                del self.pending[tp]
+
+    def stats(self):
+        """
+        Get processing statistics.
+        :return: dictionary of committed records, batches, commits, elapsed seconds and records_per_second
+        """
+        stats = dict(self.counters)
+        stats['elapsed'] = time.time() - self.started if self.started else 0.0
+        stats['records_per_second'] = stats['records'] / stats['elapsed'] if stats['elapsed'] else 0.0
+        return stats
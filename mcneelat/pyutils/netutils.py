@@ -1,9 +1,81 @@
+from array import array
+from bisect import bisect_right
 import re
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-class PyNetAddr:
+_ip_pattern = re.compile(r'^([0-9]{1,3}\.){3}[0-9]{1,3}$')
+_all_ones = 0xFFFFFFFF
+# precomputed integer subnet masks, indexed by CIDR mask bits
+_int_masks = tuple((_all_ones << (32 - bits)) & _all_ones for bits in range(33))
+_mask_bits = dict((mask, bits) for bits, mask in enumerate(_int_masks))
+
+
+def _addr_to_int(address):
+    """
+    Convert a dotted quad string to a 32-bit integer.
+    :param address: IP address in dotted quad notation (i.e. 10.0.0.1)
+    :return: integer value of the address, or None if it is not a dotted quad with octets in 0-255
+    """
+    if not _ip_pattern.match(address):
+        return None
+    a, b, c, d = address.split('.')
+    a, b, c, d = int(a), int(b), int(c), int(d)
+    if a > 255 or b > 255 or c > 255 or d > 255:
+        return None
+    return (a << 24) | (b << 16) | (c << 8) | d
+
+
+def _int_to_addr(value):
+    """
+    Convert a 32-bit integer to a dotted quad string.
+    :param value: integer value of the address
+    :return: IP address in dotted quad notation
+    """
+    return '%d.%d.%d.%d' % (value >> 24, (value >> 16) & 255, (value >> 8) & 255, value & 255)
+
+
+def _merge_intervals(intervals):
+    """
+    Merge overlapping and adjacent address intervals in a single sweep.
+    :param intervals: iterable of (first address, last address) integer tuples, inclusive
+    :return: sorted list of disjoint, non-adjacent (first address, last address) tuples
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1] + 1:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _range_to_cidrs(start, end):
+    """
+    Split an address interval into the minimal list of CIDR blocks covering it.
+    :param start: first address of the interval as a 32-bit integer
+    :param end: last address of the interval as a 32-bit integer, inclusive
+    :return: generator of (network address, CIDR mask bits) integer tuples
+    """
+    while start <= end:
+        # largest block aligned on start that doesn't run past end
+        host_bits = (start & -start).bit_length() - 1 if start else 32
+        span_bits = (end - start + 1).bit_length() - 1
+        if span_bits < host_bits:
+            host_bits = span_bits
+        yield start, 32 - host_bits
+        start += 1 << host_bits
+
+
+class PyNetAddr(object):
     """This is a pure Python implementation of the Perl module NetAddr::IP."""
 
+    __slots__ = ('_address', '_network', 'cidr_mask')
+
     ip_re = r'^([0-9]{1,3}\.){3}[0-9]{1,3}$'
     mask_values = [0, 128, 192, 224, 240, 248, 252, 254, 255]
 
@@ -13,11 +85,87 @@ class PyNetAddr:
         :param address: single IP address, or address and mask in CIDR notation (i.e. 10.0.0.0/24)
         :param mask: subnet mask in full notation (i.e. 255.255.255.0); None if address param is in CIDR notation
         """
-        self.address, self.broadcast, self.cidr_mask, self.mask, self.network, self.range = (
-            None, None, None, None, None, None)
         if not self.set_new(address, mask):
             raise ValueError('Invalid address or subnet mask!')
 
+    @classmethod
+    def from_int(cls, network, cidr_mask, address=None):
+        """
+        Build a PyNetAddr directly from integer values, skipping string parsing and validation.
+        :param network: network address as a 32-bit integer; host bits are cleared
+        :param cidr_mask: CIDR mask bits (0-32)
+        :param address: IP address as a 32-bit integer; defaults to the network address
+        :return: PyNetAddr object
+        """
+        netaddr = cls.__new__(cls)
+        netaddr._network = network & _int_masks[cidr_mask]
+        netaddr._address = netaddr._network if address is None else address
+        netaddr.cidr_mask = cidr_mask
+        return netaddr
+
+    @property
+    def address(self):
+        """IP address in dotted quad notation."""
+        return _int_to_addr(self._address)
+
+    @property
+    def mask(self):
+        """Subnet mask in full notation."""
+        return _int_to_addr(_int_masks[self.cidr_mask])
+
+    @property
+    def network(self):
+        """Network address in dotted quad notation."""
+        return _int_to_addr(self._network)
+
+    @property
+    def broadcast(self):
+        """Broadcast address in dotted quad notation."""
+        return _int_to_addr(self.broadcast_int)
+
+    @property
+    def range(self):
+        """Range of addresses in the subnet."""
+        return PyNetAddr.calc_range(self.network, self.broadcast)
+
+    @property
+    def address_int(self):
+        """IP address as a 32-bit integer."""
+        return self._address
+
+    @property
+    def mask_int(self):
+        """Subnet mask as a 32-bit integer."""
+        return _int_masks[self.cidr_mask]
+
+    @property
+    def network_int(self):
+        """Network address as a 32-bit integer."""
+        return self._network
+
+    @property
+    def broadcast_int(self):
+        """Broadcast address as a 32-bit integer."""
+        return self._network | (_all_ones >> self.cidr_mask)
+
+    @staticmethod
+    def addr_to_int(address):
+        """
+        Convert a dotted quad string to a 32-bit integer.
+        :param address: IP address in dotted quad notation (i.e. 10.0.0.1)
+        :return: integer value of the address, or None if invalid
+        """
+        return _addr_to_int(address)
+
+    @staticmethod
+    def int_to_addr(value):
+        """
+        Convert a 32-bit integer to a dotted quad string.
+        :param value: integer value of the address
+        :return: IP address in dotted quad notation
+        """
+        return _int_to_addr(value)
+
     @staticmethod
     def is_valid_addr(address):
         """
@@ -25,16 +173,8 @@ class PyNetAddr:
         :param address: IP address or network
         :return: True if valid, False if not
         """
-        if re.search(PyNetAddr.ip_re, address):
-            splitter = address.split('.')
-            for i in range(0, len(splitter)):
-                tmp_i = int(splitter[i])
-                if i == 0 and tmp_i == 0:
-                    return False
-                if tmp_i < 0 or tmp_i > 255:
-                    return False
-            return True
-        return False
+        value = _addr_to_int(address)
+        return value is not None and value >> 24 != 0
 
     @staticmethod
     def is_valid_mask(mask):
@@ -43,18 +183,7 @@ class PyNetAddr:
         :param mask: subnet mask in full notation (i.e. 255.255.255.0)
         :return: True if valid, False if not
         """
-        if re.search(PyNetAddr.ip_re, mask):
-            splitter = mask.split('.')
-            for i in range(0, len(splitter)):
-                tmp_i = int(splitter[i])
-                if tmp_i not in PyNetAddr.mask_values:
-                    return False
-                # check for next octet as <= current
-                if i > 0 and tmp_i > int(splitter[i - 1]):
-                    return False
-            # PyNetAddr.calc_cidr_mask(mask)
-            return True
-        return False
+        return _addr_to_int(mask) in _mask_bits
 
     @staticmethod
     def calc_network(address, mask):
@@ -64,12 +193,7 @@ class PyNetAddr:
         :param mask: subnet mask
         :return: network address
         """
-        addr_splitter = address.split('.')
-        mask_splitter = mask.split('.')
-        network_arr = []
-        for i in range(0, len(addr_splitter)):
-            network_arr.append(str(int(addr_splitter[i]) & int(mask_splitter[i])))
-        return '.'.join(network_arr)
+        return _int_to_addr(_addr_to_int(address) & _addr_to_int(mask))
 
     @staticmethod
     def calc_broadcast(address, mask):
@@ -79,29 +203,8 @@ class PyNetAddr:
         :param mask: subnet mask
         :return: broadcast address
         """
-        network = PyNetAddr.calc_network(address, mask)
-        network_splitter = network.split('.')
-        mask_splitter = mask.split('.')
-        i = len(mask_splitter) - 1
-        breaker = False
-        while i >= 0 and not breaker:
-            network_octet = format(int(str(bin(int(network_splitter[i])))[2:], 2),
-                                   '{fill}{width}b'.format(width=8, fill=0))
-            mask_octet = format(int(str(bin(int(mask_splitter[i])))[2:], 2), '{fill}{width}b'.format(width=8, fill=0))
-
-            j = len(mask_octet) - 1
-            tmp_octet = list(network_octet)
-            while j >= 0:
-                if mask_octet[j] == '0':
-                    tmp_octet[j] = '1'
-                elif mask_octet[j] == '1':
-                    breaker = True
-                    break
-                j -= 1
-
-            network_splitter[i] = str(int(''.join(tmp_octet), 2))
-            i -= 1
-        return '.'.join(network_splitter)
+        int_mask = _addr_to_int(mask)
+        return _int_to_addr((_addr_to_int(address) & int_mask) | (~int_mask & _all_ones))
 
     @staticmethod
     def calc_range(network, broadcast):
@@ -120,12 +223,7 @@ class PyNetAddr:
         :param mask: full notation subnet mask (i.e. 255.255.255.0)
         :return: subnet mask in CIDR notation (i.e. /24)
         """
-        mask_splitter = mask.split('.')
-        cidr_mask = 0
-        for i in range(0, len(mask_splitter)):
-            mask_octet = format(int(str(bin(int(mask_splitter[i])))[2:], 2), '{fill}{width}b'.format(width=8, fill=0))
-            cidr_mask += mask_octet.count('1')
-        return cidr_mask
+        return bin(_addr_to_int(mask)).count('1')
 
     @staticmethod
     def calc_full_mask(cidr_mask):
@@ -134,10 +232,7 @@ class PyNetAddr:
         :param cidr_mask: CIDR mask bits
         :return: full notation subnet mask
         """
-        cidr_bits = '1' * cidr_mask + '0' * (32 - cidr_mask)
-        cidr_bits_arr = [str(int(cidr_bits[:8], 2)), str(int(cidr_bits[8:16], 2)), str(int(cidr_bits[16:24], 2)),
-                         str(int(cidr_bits[24:], 2))]
-        return '.'.join(cidr_bits_arr)
+        return _int_to_addr(_int_masks[cidr_mask])
 
     @staticmethod
     def within(network1, network2):
@@ -150,46 +245,25 @@ class PyNetAddr:
         if not isinstance(network1, PyNetAddr) or \
                 not isinstance(network2, PyNetAddr):
             return False
-        if network1.network == network2.network:
-            return True
-        mask1_splitter = network1.mask.split('.')
-        mask2_splitter = network2.mask.split('.')
-        total1 = int(mask1_splitter[0]) + int(mask1_splitter[1]) + int(mask1_splitter[2]) + int(mask1_splitter[3])
-        total2 = int(mask2_splitter[0]) + int(mask2_splitter[1]) + int(mask2_splitter[2]) + int(mask2_splitter[3])
-        if total1 < total2:
-            netaddr3 = PyNetAddr(network2.network, network1.mask)
-            if network1.network == netaddr3.network:
-                return True
-        elif total2 < total1:
-            netaddr3 = PyNetAddr(network1.network, network2.mask)
-            if network2.network == netaddr3.network:
-                return True
-        return False
+        int_mask = _int_masks[min(network1.cidr_mask, network2.cidr_mask)]
+        return network1._network & int_mask == network2._network & int_mask
 
     @staticmethod
     def summarize(subnets):
         """
-        Compress a given list of subnets by removing those which are contained inside of others in the list
+        Compress a given list of subnets into the smallest set of CIDR blocks covering the same addresses, removing
+        those which are contained inside of others and merging overlapping or adjacent ones (i.e. two /25s into a /24)
         :param subnets: list of PyNetAddr objects to summarize
-        :return: sorted list of summarized PyNetAddr objects
+        :return: list of summarized PyNetAddr objects sorted by network address
         """
         # make sure we've actually received a list of PyNetAddr objects
-        subnets = [sn for sn in subnets if isinstance(sn, PyNetAddr)]
-        if len(subnets) == 0:
+        intervals = [(sn._network, sn._network | (_all_ones >> sn.cidr_mask)) for sn in subnets
+                     if isinstance(sn, PyNetAddr)]
+        if len(intervals) == 0:
             return False
-        sorted_nets = sorted(subnets, key=lambda sn: sn.cidr_mask)
-        summarized = set()
-        while len(sorted_nets) > 0:
-            tmp_net = sorted_nets.pop()
-            found = False
-            for sn in sorted_nets:
-                if PyNetAddr.within(tmp_net, sn):
-                    summarized.add(sn)
-                    found = True
-                    break
-            if not found:
-                summarized.add(tmp_net)
-        return sorted(summarized, key=lambda sn: "%s/%s" % (sn.cidr_mask, sn.network))
+        return [PyNetAddr.from_int(network, cidr_mask)
+                for start, end in _merge_intervals(intervals)
+                for network, cidr_mask in _range_to_cidrs(start, end)]
 
     def set_new(self, address, mask):
         """
@@ -198,20 +272,621 @@ class PyNetAddr:
         :param mask: subnet mask in full notation (i.e. 255.255.255.0); None if address param is in CIDR notation
         :return: True if successful, False otherwise
         """
-        if PyNetAddr.is_valid_addr(address.split("/")[0]):
-            self.address = address.split("/")[0]
-        else:
+        address, _, cidr_bits = address.partition('/')
+        int_address = _addr_to_int(address)
+        if int_address is None or int_address >> 24 == 0:
             print("Error, invalid IP address!")
             return False
         if mask is None:
-            mask = PyNetAddr.calc_full_mask(int(address.split("/")[1]))
-        if PyNetAddr.is_valid_mask(mask):
-            self.mask = mask
-            self.cidr_mask = PyNetAddr.calc_cidr_mask(self.mask)
+            # a bare address with no mask is a single host
+            try:
+                cidr_mask = int(cidr_bits) if cidr_bits else 32
+            except ValueError:
+                cidr_mask = -1
+            if not 0 <= cidr_mask <= 32:
+                print("Error, invalid subnet mask!")
+                return False
         else:
-            print("Error, invalid subnet mask!")
+            cidr_mask = _mask_bits.get(_addr_to_int(mask))
+            if cidr_mask is None:
+                print("Error, invalid subnet mask!")
+                return False
+        self._address = int_address
+        self._network = int_address & _int_masks[cidr_mask]
+        self.cidr_mask = cidr_mask
+        return True
+
+
+def _prefix_key(prefix):
+    """
+    Resolve a prefix to its integer network and CIDR mask bits.
+    :param prefix: PyNetAddr object or CIDR notation string (i.e. 10.0.0.0/24)
+    :return: tuple -- network address as a 32-bit integer, CIDR mask bits
+    """
+    if not isinstance(prefix, PyNetAddr):
+        prefix = PyNetAddr(prefix)
+    return prefix.network_int, prefix.cidr_mask
+
+
+def _address_key(address):
+    """
+    Resolve an address to look up to an integer address and the number of significant bits.
+    :param address: IP address as a dotted quad string or 32-bit integer, or a PyNetAddr object
+    :return: tuple -- address as a 32-bit integer, number of significant bits
+    """
+    if isinstance(address, PyNetAddr):
+        return address.network_int, address.cidr_mask
+    if isinstance(address, int):
+        if not 0 <= address <= _all_ones:
+            raise ValueError('Invalid address!')
+        return address, 32
+    value = _addr_to_int(address)
+    if value is None:
+        raise ValueError('Invalid address!')
+    return value, 32
+
+
+class _PrefixNode(object):
+    """Node of a PyNetAddrIndex trie; glue nodes only exist to branch and carry no payload."""
+
+    __slots__ = ('network', 'cidr_mask', 'payload', 'is_set', 'children')
+
+    def __init__(self, network, cidr_mask):
+        self.network = network
+        self.cidr_mask = cidr_mask
+        self.payload = None
+        self.is_set = False
+        self.children = [None, None]
+
+
+class PyNetAddrIndex(object):
+    """Path compressed (Patricia) radix trie mapping network prefixes to arbitrary payloads."""
+
+    def __init__(self, prefixes=None):
+        """
+        Initialize class.
+        :param prefixes: optional prefixes to load; either a dictionary where k = prefix, v = payload, or an iterable
+            of prefixes or (prefix, payload) tuples, where each prefix is a PyNetAddr object or CIDR notation string
+        """
+        self._root = _PrefixNode(0, 0)
+        self._size = 0
+        if prefixes is not None:
+            self.update(prefixes)
+
+    def __len__(self):
+        return self._size
+
+    def __contains__(self, prefix):
+        return self._find(*_prefix_key(prefix)) is not None
+
+    def __iter__(self):
+        for node in self._nodes():
+            yield PyNetAddr.from_int(node.network, node.cidr_mask)
+
+    def update(self, prefixes):
+        """
+        Add many prefixes to the index.
+        :param prefixes: either a dictionary where k = prefix, v = payload, or an iterable of prefixes or
+            (prefix, payload) tuples
+        :return: None
+        """
+        if isinstance(prefixes, dict):
+            prefixes = prefixes.items()
+        for item in prefixes:
+            if isinstance(item, tuple):
+                self.add(*item)
+            else:
+                self.add(item)
+
+    def add(self, prefix, payload=None):
+        """
+        Add a prefix to the index, replacing the payload if the prefix is already present.
+        :param prefix: PyNetAddr object or CIDR notation string (i.e. 10.0.0.0/24)
+        :param payload: any object to associate with the prefix
+        :return: None
+        """
+        network, cidr_mask = _prefix_key(prefix)
+        node = self._root
+        while True:
+            if node.cidr_mask == cidr_mask:
+                break
+            bit = (network >> (31 - node.cidr_mask)) & 1
+            child = node.children[bit]
+            if child is None:
+                child = node.children[bit] = _PrefixNode(network, cidr_mask)
+                node = child
+                break
+            limit = min(child.cidr_mask, cidr_mask)
+            common = min(32 - ((child.network ^ network) & _int_masks[limit]).bit_length(), limit)
+            if common >= child.cidr_mask:
+                node = child
+                continue
+            leaf = _PrefixNode(network, cidr_mask)
+            if common >= cidr_mask:
+                # the new prefix sits between node and child
+                leaf.children[(child.network >> (31 - cidr_mask)) & 1] = child
+                node.children[bit] = leaf
+            else:
+                # prefixes diverge above both masks, so branch them off a glue node
+                glue = _PrefixNode(network & _int_masks[common], common)
+                glue.children[(child.network >> (31 - common)) & 1] = child
+                glue.children[(network >> (31 - common)) & 1] = leaf
+                node.children[bit] = glue
+            node = leaf
+            break
+        if not node.is_set:
+            node.is_set = True
+            self._size += 1
+        node.payload = payload
+
+    def get(self, prefix, default=None):
+        """
+        Get the payload stored for an exact prefix.
+        :param prefix: PyNetAddr object or CIDR notation string (i.e. 10.0.0.0/24)
+        :param default: value to return if the prefix is not in the index
+        :return: payload of the prefix, or default if not found
+        """
+        node = self._find(*_prefix_key(prefix))
+        return default if node is None else node.payload
+
+    def remove(self, prefix):
+        """
+        Remove a prefix from the index; the trie keeps its shape, so removals are cheap but don't reclaim nodes.
+        :param prefix: PyNetAddr object or CIDR notation string (i.e. 10.0.0.0/24)
+        :return: True if the prefix was removed, False if it wasn't in the index
+        """
+        node = self._find(*_prefix_key(prefix))
+        if node is None:
             return False
-        self.network = PyNetAddr.calc_network(self.address, self.mask)
-        self.broadcast = PyNetAddr.calc_broadcast(self.address, self.mask)
-        self.range = PyNetAddr.calc_range(self.network, self.broadcast)
+        node.is_set = False
+        node.payload = None
+        self._size -= 1
         return True
+
+    def longest_match(self, address):
+        """
+        Find the most specific prefix containing an address.
+        :param address: IP address as a dotted quad string or 32-bit integer, or a PyNetAddr object
+        :return: tuple -- matching PyNetAddr object, payload; or None if no prefix contains the address
+        """
+        matches = self._matching_nodes(address)
+        if not matches:
+            return None
+        best = matches[-1]
+        return PyNetAddr.from_int(best.network, best.cidr_mask), best.payload
+
+    def lookup(self, address, default=None):
+        """
+        Get the payload of the most specific prefix containing an address.
+        :param address: IP address as a dotted quad string or 32-bit integer, or a PyNetAddr object
+        :param default: value to return if no prefix contains the address
+        :return: payload of the longest matching prefix, or default if not found
+        """
+        matches = self._matching_nodes(address)
+        return matches[-1].payload if matches else default
+
+    def all_matches(self, address):
+        """
+        Find every prefix containing an address.
+        :param address: IP address as a dotted quad string or 32-bit integer, or a PyNetAddr object
+        :return: list of (PyNetAddr object, payload) tuples, ordered from least to most specific
+        """
+        return [(PyNetAddr.from_int(node.network, node.cidr_mask), node.payload)
+                for node in self._matching_nodes(address)]
+
+    def _matching_nodes(self, address):
+        """
+        Walk the trie along an address, collecting the nodes of every prefix that contains it.
+        :param address: IP address as a dotted quad string or 32-bit integer, or a PyNetAddr object
+        :return: list of _PrefixNode objects, ordered from least to most specific
+        """
+        value, bits = _address_key(address)
+        node = self._root
+        matches = []
+        while node is not None and node.cidr_mask <= bits and \
+                value & _int_masks[node.cidr_mask] == node.network:
+            if node.is_set:
+                matches.append(node)
+            if node.cidr_mask == 32:
+                break
+            node = node.children[(value >> (31 - node.cidr_mask)) & 1]
+        return matches
+
+    def items(self):
+        """
+        Iterate over all prefixes in the index, sorted by network address then mask.
+        :return: generator of (PyNetAddr object, payload) tuples
+        """
+        for node in self._nodes():
+            yield PyNetAddr.from_int(node.network, node.cidr_mask), node.payload
+
+    def _find(self, network, cidr_mask):
+        """
+        Find the node holding an exact prefix.
+        :param network: network address as a 32-bit integer
+        :param cidr_mask: CIDR mask bits
+        :return: _PrefixNode object, or None if the prefix is not in the index
+        """
+        node = self._root
+        while node is not None and node.cidr_mask <= cidr_mask and \
+                network & _int_masks[node.cidr_mask] == node.network:
+            if node.cidr_mask == cidr_mask:
+                return node if node.is_set else None
+            node = node.children[(network >> (31 - node.cidr_mask)) & 1]
+        return None
+
+    def _nodes(self):
+        """
+        Walk the trie in order without recursion.
+        :return: generator of _PrefixNode objects that hold a prefix
+        """
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node.is_set:
+                yield node
+            if node.children[1] is not None:
+                stack.append(node.children[1])
+            if node.children[0] is not None:
+                stack.append(node.children[0])
+
+
+class IPSet(object):
+    """Set of IPv4 addresses stored as sorted, disjoint integer intervals."""
+
+    def __init__(self, prefixes=None):
+        """
+        Initialize class.
+        :param prefixes: optional iterable of PyNetAddr objects, CIDR notation strings or single IP address strings
+        """
+        intervals = []
+        for prefix in prefixes or ():
+            network, cidr_mask = _prefix_key(prefix)
+            intervals.append((network, network | (_all_ones >> cidr_mask)))
+        self._set_intervals(_merge_intervals(intervals))
+
+    @classmethod
+    def from_ranges(cls, ranges):
+        """
+        Build an IPSet from address ranges.
+        :param ranges: iterable of (first address, last address) tuples, inclusive, as dotted quad strings or integers
+        :return: IPSet object
+        """
+        intervals = []
+        for start, end in ranges:
+            start, end = _address_key(start)[0], _address_key(end)[0]
+            if start > end:
+                raise ValueError('Invalid range!')
+            intervals.append((start, end))
+        ipset = cls.__new__(cls)
+        ipset._set_intervals(_merge_intervals(intervals))
+        return ipset
+
+    @classmethod
+    def _from_intervals(cls, intervals):
+        """
+        Build an IPSet from intervals that are already sorted, disjoint and non-adjacent.
+        :param intervals: list of (first address, last address) integer tuples
+        :return: IPSet object
+        """
+        ipset = cls.__new__(cls)
+        ipset._set_intervals(intervals)
+        return ipset
+
+    def _set_intervals(self, intervals):
+        self._starts = array('L', [start for start, _ in intervals])
+        self._ends = array('L', [end for _, end in intervals])
+
+    def __len__(self):
+        return self.size
+
+    def __bool__(self):
+        return len(self._starts) > 0
+
+    __nonzero__ = __bool__
+
+    def __eq__(self, other):
+        if not isinstance(other, IPSet):
+            return NotImplemented
+        return self._starts == other._starts and self._ends == other._ends
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __contains__(self, address):
+        """
+        Check whether an address, or every address of a PyNetAddr network, is in the set.
+        :param address: IP address as a dotted quad string or 32-bit integer, or a PyNetAddr object
+        :return: True if contained, False otherwise
+        """
+        value, bits = _address_key(address)
+        pos = bisect_right(self._starts, value) - 1
+        return pos >= 0 and (value | (_all_ones >> bits)) <= self._ends[pos]
+
+    def __iter__(self):
+        return self.iter_hosts()
+
+    def __or__(self, other):
+        return self.union(other)
+
+    def __and__(self, other):
+        return self.intersection(other)
+
+    def __sub__(self, other):
+        return self.difference(other)
+
+    @property
+    def size(self):
+        """Number of addresses in the set."""
+        return sum(end - start + 1 for start, end in zip(self._starts, self._ends))
+
+    def intervals(self):
+        """
+        Get the set as address ranges.
+        :return: list of (first address, last address) integer tuples, inclusive
+        """
+        return list(zip(self._starts, self._ends))
+
+    def iter_hosts(self, as_int=False):
+        """
+        Lazily iterate over every address in the set, in ascending order.
+        :param as_int: yield 32-bit integers instead of dotted quad strings
+        :return: generator of addresses
+        """
+        for start, end in zip(self._starts, self._ends):
+            if as_int:
+                for value in range(start, end + 1):
+                    yield value
+            else:
+                for value in range(start, end + 1):
+                    yield _int_to_addr(value)
+
+    def cidrs(self):
+        """
+        Convert the set to the minimal list of CIDR blocks covering it.
+        :return: list of PyNetAddr objects sorted by network address
+        """
+        return [PyNetAddr.from_int(network, cidr_mask)
+                for start, end in zip(self._starts, self._ends)
+                for network, cidr_mask in _range_to_cidrs(start, end)]
+
+    def union(self, other):
+        """
+        Get all addresses in either set.
+        :param other: IPSet object
+        :return: new IPSet object
+        """
+        # both inputs are sorted runs, so the sort inside the merge is linear
+        return IPSet._from_intervals(_merge_intervals(self.intervals() + other.intervals()))
+
+    def intersection(self, other):
+        """
+        Get the addresses in both sets.
+        :param other: IPSet object
+        :return: new IPSet object
+        """
+        starts1, ends1, starts2, ends2 = self._starts, self._ends, other._starts, other._ends
+        i, j = 0, 0
+        result = []
+        while i < len(starts1) and j < len(starts2):
+            start = max(starts1[i], starts2[j])
+            end = min(ends1[i], ends2[j])
+            if start <= end:
+                result.append((start, end))
+            if ends1[i] < ends2[j]:
+                i += 1
+            else:
+                j += 1
+        return IPSet._from_intervals(result)
+
+    def difference(self, other):
+        """
+        Get the addresses in this set that are not in the other set.
+        :param other: IPSet object
+        :return: new IPSet object
+        """
+        starts2, ends2 = other._starts, other._ends
+        j = 0
+        result = []
+        for start, end in zip(self._starts, self._ends):
+            # skip blocks that end before this interval starts
+            while j < len(starts2) and ends2[j] < start:
+                j += 1
+            k = j
+            while k < len(starts2) and starts2[k] <= end and start <= end:
+                if starts2[k] > start:
+                    result.append((start, starts2[k] - 1))
+                start = max(start, ends2[k] + 1)
+                k += 1
+            if start <= end:
+                result.append((start, end))
+        return IPSet._from_intervals(result)
+
+    def issubset(self, other):
+        """
+        Check whether every address in this set is also in the other set.
+        :param other: IPSet object
+        :return: True if this set is a subset, False otherwise
+        """
+        return not self.difference(other)
+
+
+def _require_numpy():
+    """
+    Make sure NumPy is available before running a batch operation.
+    :return: None
+    """
+    if np is None:
+        raise ImportError('NumPy is required for batch operations; install it with "pip install numpy"')
+
+
+class PyNetAddrBatch(object):
+    """Vectorized versions of the PyNetAddr calculations that work on NumPy uint32 arrays of addresses."""
+
+    # longest dotted quad is 15 characters, so anything using the 16th is invalid
+    addr_width = 16
+
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def parse(addresses):
+        """
+        Parse and validate dotted quad strings in bulk, using the same rules as PyNetAddr.is_valid_addr.
+        :param addresses: sequence or NumPy array of IP address strings (str or bytes)
+        :return: tuple -- uint32 array of addresses (0 where invalid), boolean array of which entries are valid
+        """
+        _require_numpy()
+        width = PyNetAddrBatch.addr_width
+        addresses = np.asarray(addresses)
+        if addresses.dtype.kind == 'S':
+            chars = addresses.astype('S%d' % width).view(np.uint8)
+        else:
+            chars = addresses.astype('U%d' % width).view(np.uint32)
+        # one row per character position, so each step below works on contiguous memory
+        chars = np.ascontiguousarray(chars.reshape(-1, width).T)
+        is_digit = (chars >= 48) & (chars <= 57)
+        is_dot = chars == 46
+        is_nul = chars == 0
+        # only digits and dots, NUL padding only at the end, and exactly three dots
+        valid = (is_digit | is_dot | is_nul).all(axis=0)
+        valid &= (is_nul[1:] >= is_nul[:-1]).all(axis=0)
+        valid &= is_dot.sum(axis=0) == 3
+        valid &= is_nul[width - 1]
+        # an octet ends on a dot, or on the first NUL after the last dot
+        ends = is_dot.copy()
+        ends[1:] |= is_nul[1:] & ~is_nul[:-1]
+        ends = ends.astype(np.uint32)
+        values = np.where(is_digit, chars - 48, 0).astype(np.uint32)
+        count = chars.shape[1]
+        result = np.zeros(count, dtype=np.uint32)
+        octet = np.zeros(count, dtype=np.uint32)
+        digits = np.zeros(count, dtype=np.uint32)
+        for col in range(width):
+            end = ends[col]
+            keep = 1 - end
+            valid &= (keep | ((digits >= 1) & (digits <= 3) & (octet <= 255))).astype(bool)
+            result = (result << (end << 3)) | (octet * end)
+            octet = octet * keep * 10 + values[col]
+            digits = digits * keep + is_digit[col]
+        valid &= (result >> np.uint32(24)) != 0
+        result[~valid] = 0
+        return result, valid
+
+    @staticmethod
+    def to_strings(addresses):
+        """
+        Format an array of integer addresses as dotted quad strings.
+        :param addresses: uint32 array of addresses
+        :return: NumPy array of IP address strings
+        """
+        _require_numpy()
+        addresses = np.asarray(addresses, dtype=np.uint32)
+        octets = [((addresses >> np.uint32(shift)) & np.uint32(255)).astype('U3') for shift in (24, 16, 8, 0)]
+        result = octets[0]
+        for octet in octets[1:]:
+            result = np.char.add(np.char.add(result, '.'), octet)
+        return result
+
+    @staticmethod
+    def masks(cidr_masks):
+        """
+        Convert CIDR mask bits to integer subnet masks.
+        :param cidr_masks: CIDR mask bits, as a single integer or an array
+        :return: uint32 subnet mask or array of masks
+        """
+        _require_numpy()
+        return np.asarray(_int_masks, dtype=np.uint32)[np.asarray(cidr_masks, dtype=np.intp)]
+
+    @staticmethod
+    def network(addresses, cidr_masks):
+        """
+        Calculate network addresses for many addresses at once.
+        :param addresses: uint32 array of addresses, or a sequence of IP address strings
+        :param cidr_masks: CIDR mask bits, as a single integer or an array matching addresses
+        :return: uint32 array of network addresses
+        """
+        return PyNetAddrBatch._to_uint32(addresses) & PyNetAddrBatch.masks(cidr_masks)
+
+    @staticmethod
+    def broadcast(addresses, cidr_masks):
+        """
+        Calculate broadcast addresses for many addresses at once.
+        :param addresses: uint32 array of addresses, or a sequence of IP address strings
+        :param cidr_masks: CIDR mask bits, as a single integer or an array matching addresses
+        :return: uint32 array of broadcast addresses
+        """
+        return PyNetAddrBatch._to_uint32(addresses) | ~PyNetAddrBatch.masks(cidr_masks)
+
+    @staticmethod
+    def contains(addresses, subnets):
+        """
+        Check which addresses fall inside any of the given subnets.
+        :param addresses: uint32 array of addresses, or a sequence of IP address strings
+        :param subnets: list of PyNetAddr objects or CIDR notation strings
+        :return: boolean array; invalid addresses are never contained
+        """
+        addresses, valid = PyNetAddrBatch._to_uint32(addresses, with_valid=True)
+        intervals = []
+        for subnet in subnets:
+            network, cidr_mask = _prefix_key(subnet)
+            intervals.append((network, network | (_all_ones >> cidr_mask)))
+        merged = _merge_intervals(intervals)
+        if not merged:
+            return np.zeros(addresses.shape, dtype=bool)
+        starts = np.array([start for start, _ in merged], dtype=np.uint32)
+        ends = np.array([end for _, end in merged], dtype=np.uint32)
+        pos = np.searchsorted(starts, addresses, side='right') - 1
+        inside = (pos >= 0) & (addresses <= ends[np.maximum(pos, 0)])
+        return inside & valid
+
+    @staticmethod
+    def match(addresses, subnets):
+        """
+        Find the first subnet in the list that contains each address.
+        :param addresses: uint32 array of addresses, or a sequence of IP address strings
+        :param subnets: list of PyNetAddr objects or CIDR notation strings
+        :return: int64 array of indexes into subnets, -1 where no subnet matches or the address is invalid
+        """
+        addresses, valid = PyNetAddrBatch._to_uint32(addresses, with_valid=True)
+        keys = [_prefix_key(subnet) for subnet in subnets]
+        no_match = len(keys)
+        result = np.full(addresses.shape, no_match, dtype=np.int64)
+        if keys:
+            networks = np.array([network for network, _ in keys], dtype=np.uint32)
+            bits = np.array([cidr_mask for _, cidr_mask in keys], dtype=np.intp)
+            indexes = np.arange(no_match, dtype=np.int64)
+            # one sorted lookup table per distinct mask length, keeping the lowest index for duplicate networks
+            for cidr_mask in np.unique(bits):
+                selected = bits == cidr_mask
+                order = np.lexsort((indexes[selected], networks[selected]))
+                table, first = np.unique(networks[selected][order], return_index=True)
+                table_indexes = indexes[selected][order][first]
+                masked = addresses & np.uint32(_int_masks[cidr_mask])
+                pos = np.minimum(np.searchsorted(table, masked), len(table) - 1)
+                hit = table[pos] == masked
+                result = np.where(hit, np.minimum(result, table_indexes[pos]), result)
+        result[(result == no_match) | ~valid] = -1
+        return result
+
+    @staticmethod
+    def _to_uint32(addresses, with_valid=False):
+        """
+        Turn an array of integers or IP address strings into a uint32 array.
+        :param addresses: uint32 array of addresses, or a sequence of IP address strings
+        :param with_valid: whether or not to also return the validity array
+        :return: uint32 array of addresses, plus the boolean validity array if with_valid
+        """
+        _require_numpy()
+        addresses = np.asarray(addresses)
+        if addresses.dtype.kind in 'SUO':
+            parsed, valid = PyNetAddrBatch.parse(addresses)
+        else:
+            parsed = addresses.astype(np.uint32)
+            valid = np.ones(parsed.shape, dtype=bool)
+        if with_valid:
+            return parsed, valid
+        return parsed
@@ -24,4 +24,5 @@ setup(
     packages=find_packages(),
     include_package_data=True,
     install_requires=["dnspython", "kafka-python", "psycopg2-binary", "python-ldap", "requests"],
+    extras_require={"numpy": ["numpy"], "orjson": ["orjson"]},
 )
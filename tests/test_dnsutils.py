@@ -0,0 +1,79 @@
+"""
+Tests for DNSCache, built on hand-made responses so they run without a network.
+"""
+import time
+import unittest
+
+import dns.message
+import dns.name
+import dns.rdataclass
+import dns.rdatatype
+import dns.resolver
+import dns.rrset
+
+from mcneelat.pyutils.dnsutils import DNSCache
+
+
+def make_response(name, qtype, answer=(), authority=()):
+    """
+    Build a response to a query from (name, ttl, rdtype, rdata) tuples for its answer and authority sections.
+    """
+    response = dns.message.make_response(dns.message.make_query(name, qtype))
+    for section, records in ((response.answer, answer), (response.authority, authority)):
+        for owner, ttl, rdtype, rdata in records:
+            rrset = dns.rrset.from_text(owner, ttl, 'IN', rdtype, rdata)
+            # find_rrset keeps the message's index up to date, which resolving the CNAME chain relies on
+            response.find_rrset(section, rrset.name, rrset.rdclass, rrset.rdtype, create=True).update(rrset)
+    return response
+
+
+class OldNoAnswer(dns.resolver.NoAnswer):
+    """NoAnswer as dnspython 1.16 raises it, with the response only in kwargs."""
+    response = None
+
+
+class DNSCacheTest(unittest.TestCase):
+
+    def assertExpiresIn(self, cache, name, qtype, seconds):
+        expiration = cache.entries[cache.make_key(name, qtype)][0]
+        self.assertAlmostEqual(expiration - time.time(), seconds, delta=2)
+
+    def test_put_uses_lowest_ttl_of_cname_chain(self):
+        cache = DNSCache(min_ttl=0)
+        response = make_response('www.example.com', 'A', answer=[
+            ('www.example.com.', 60, 'CNAME', 'edge.example.net.'),
+            ('edge.example.net.', 3600, 'A', '192.0.2.1')])
+        answer = dns.resolver.Answer(dns.name.from_text('www.example.com'), dns.rdatatype.A, dns.rdataclass.IN,
+                                     response)
+        cache.put('www.example.com', 'A', answer)
+        self.assertExpiresIn(cache, 'www.example.com', 'A', 60)
+        self.assertEqual(cache.get('WWW.example.com.', 'a'), (True, answer))
+
+    def test_put_negative_no_answer_uses_soa(self):
+        cache = DNSCache(min_ttl=0)
+        response = make_response('example.com', 'AAAA', authority=[
+            ('example.com.', 900, 'SOA', 'ns.example.com. admin.example.com. 1 7200 3600 1209600 120')])
+        cache.put_negative('example.com', 'AAAA', dns.resolver.NoAnswer(response=response))
+        self.assertExpiresIn(cache, 'example.com', 'AAAA', 120)
+        self.assertEqual(cache.get('example.com', 'AAAA'), (True, False))
+        # dnspython 1.16 raises NoAnswer without a response() method
+        cache.put_negative('example.org', 'AAAA', OldNoAnswer(response=response))
+        self.assertExpiresIn(cache, 'example.org', 'AAAA', 120)
+
+    def test_put_negative_nxdomain_uses_soa(self):
+        cache = DNSCache(min_ttl=0)
+        qname = dns.name.from_text('missing.example.com')
+        response = make_response('missing.example.com', 'A', authority=[
+            ('example.com.', 30, 'SOA', 'ns.example.com. admin.example.com. 1 7200 3600 1209600 120')])
+        cache.put_negative('missing.example.com', 'A', dns.resolver.NXDOMAIN(qnames=[qname],
+                                                                           responses={qname: response}))
+        self.assertExpiresIn(cache, 'missing.example.com', 'A', 30)
+
+    def test_put_negative_without_soa_uses_negative_ttl(self):
+        cache = DNSCache(negative_ttl=300)
+        cache.put_negative('example.com', 'MX', dns.resolver.NoAnswer(response=make_response('example.com', 'MX')))
+        self.assertExpiresIn(cache, 'example.com', 'MX', 300)
+
+
+if __name__ == '__main__':
+    unittest.main()